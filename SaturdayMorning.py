@@ -25,21 +25,23 @@
 import os
 import sys
 import json
-import shutil
+import threading
+import time
 import traceback
-from copy import deepcopy
 
 import wx
-from wx.lib.agw import genericmessagedialog as GMD
 
 import chart_util
+import fnf_util
+import analytics_util
+import ogg_util
 
 
 
-def ExceptMyFate():
+def ExceptMyFate(exc_info=None):
     frame = wx.GetApp().GetTopWindow()
 
-    tb = traceback.format_exception(*sys.exc_info())
+    tb = traceback.format_exception(*(exc_info or sys.exc_info()))
     exception_str = "".join(tb)
     
     mb = wx.MessageDialog(frame, exception_str, 'I`ve error', wx.ICON_ERROR | wx.CENTRE | wx.STAY_ON_TOP)
@@ -51,13 +53,85 @@ def except_decorator(func):
         try:
             func(self, *args, **kwargs)
         except:
+            if not wx.IsMainThread():
+                raise               # Let the Job report it from the main thread
             ExceptMyFate()
     return wrapper
 
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(threading.Thread):
+    """
+    Runs work(job) off the wx main thread. The work calls job.Stage(label)
+    as it goes, which times each stage, checks for cancellation, and posts
+    progress back to the frame with wx.CallAfter.
+    """
+
+    def __init__(self, frame, title, work, n_stages, on_done=None):
+        super(Job, self).__init__(daemon=True)
+        self.frame = frame
+        self.title = title
+        self.work = work
+        self.n_stages = n_stages
+        self.on_done = on_done
+        self.timings = []
+        self.details = []           # extra lines for Summary()
+        self.cancelled = threading.Event()
+        self._stage = None
+        self._stage_start = None
+
+    def Cancel(self):
+        self.cancelled.set()
+
+    def Check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f'{self.title} cancelled')
+
+    def Stage(self, label):
+        self._EndStage()
+        self.Check()
+        self._stage = label
+        self._stage_start = time.perf_counter()
+        wx.CallAfter(self.frame.OnJobStage, self, len(self.timings), label)
+
+    def _EndStage(self):
+        if self._stage is not None:
+            self.timings.append((self._stage, time.perf_counter() - self._stage_start))
+            self._stage = None
+
+    def run(self):
+        exc_info = None
+        try:
+            self.work(self)
+            self._EndStage()
+        except:
+            exc_info = sys.exc_info()
+        wx.CallAfter(self.frame.OnJobDone, self, exc_info)
+
+    def Summary(self):
+        total = sum(dt for _, dt in self.timings)
+        stages = ', '.join(f'{label} {dt:.2f} s' for label, dt in self.timings)
+        return '\n'.join([f'{self.title} done in {total:.2f} s ({stages})'] + self.details)
+
+
 class SaturdayMorning(wx.Frame):
     """
     """
 
+    SLOTS = fnf_util.SLOTS
+
+    # The conversion itself lives in fnf_util; these stay here for older scripts.
+    CheckSimfile = staticmethod(fnf_util.CheckSimfile)
+    CheckFunkinEXE = staticmethod(fnf_util.CheckFunkinEXE)
+    GetTimingEffects = staticmethod(fnf_util.GetTimingEffects)
+    B2T = staticmethod(fnf_util.B2T)
+    CalculateTimes = staticmethod(fnf_util.CalculateTimes)
+    CalculateHolds = staticmethod(fnf_util.CalculateHolds)
+    BuildSongName = staticmethod(fnf_util.BuildSongName)
+
     def __init__(self, *args, **kw):
         super(SaturdayMorning, self).__init__(*args, **kw)
 
@@ -67,19 +141,23 @@ class SaturdayMorning(wx.Frame):
             self.root = os.path.dirname(__file__)
 
         self.itch = False       # Using the itch.io version's directory structure?
-        self.slots = {'Easy': '-easy', 'Normal': '', 'Hard': '-hard'}
+        self.slots = dict(SaturdayMorning.SLOTS)
         self.data = {}
         self.songlist = []
         self.characters = []
         self.charts = []
+        self.compiled = {}      # (opponent chart, player chart) -> CompileFNF() result
+        self.metrics = {}       # chart -> analytics_util.ChartMetrics()
+        self.audio_fit = None   # ogg_util.AudioFit()
         self.name = ''
         self.simfile = None
+        self.job = None
+        self.preview_timer = None
         self.preload = 'assets/SaturdayMorning_defaults.json'
 
         self.LoadDefaults()
         if 'path' in self.data:
-            self.itch = SaturdayMorning.CheckFunkinEXE(self.data['path'])
-            self.LoadSonglist()
+            self.itch = fnf_util.CheckFunkinEXE(self.data['path'])
             self.InitUI()
             self.UpdateUI()
             self.Centre()
@@ -125,7 +203,20 @@ class SaturdayMorning(wx.Frame):
         self.s_offset = wx.SpinCtrlDouble(p_adjustables, min=-1, max=1, initial=0, inc=0.001, style=wx.SP_ARROW_KEYS)
         self.l_speed = wx.StaticText(p_adjustables, label='Speed modifier:')
         self.s_speed = wx.SpinCtrlDouble(p_adjustables, min=0.2, max=4.0, initial=self.data.get('speed', 2.0), inc=0.01, style=wx.SP_ARROW_KEYS)
+        self.l_preview = wx.StaticText(p_adjustables, label='')
+        self.Bind(wx.EVT_SPINCTRLDOUBLE, self.OnAdjust, self.s_offset)
+        self.Bind(wx.EVT_SPINCTRLDOUBLE, self.OnAdjust, self.s_speed)
+        for s in self.slots:
+            self.Bind(wx.EVT_COMBOBOX, self.OnAdjust, self.c_slot_opp[s])
+            self.Bind(wx.EVT_COMBOBOX, self.OnAdjust, self.c_slot_plr[s])
         
+        p_job = wx.Panel(p_all)
+        self.l_job = wx.StaticText(p_job, label='')
+        self.g_job = wx.Gauge(p_job, range=1, style=wx.GA_HORIZONTAL | wx.GA_SMOOTH)
+        self.b_job_cancel = wx.Button(p_job, label='Cancel')
+        self.b_job_cancel.Disable()
+        self.Bind(wx.EVT_BUTTON, self.OnCancelJob, self.b_job_cancel)
+
         self.b_go = wx.Button(p_all, label='Go!')
         self.b_go.SetBackgroundColour(wx.Colour(0x00FF00))
         self.b_go.SetFont(f_yuge)
@@ -163,15 +254,24 @@ class SaturdayMorning(wx.Frame):
         sz_adjustables.Add(self.l_speed, pos=(0, 4), flag=wx.LEFT | wx.RIGHT | wx.EXPAND | wx.ALIGN_CENTER_VERTICAL)
         sz_adjustables.Add(self.s_speed, pos=(0, 5), flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
         sz_adjustables.Add(size=(0, 0), pos=(0, 6), flag=wx.ALL | wx.EXPAND)
+        sz_adjustables.Add(self.l_preview, pos=(1, 1), flag=wx.ALL | wx.EXPAND, span=(1, 5))
         sz_adjustables.AddGrowableCol(0)
         sz_adjustables.AddGrowableCol(3)
         sz_adjustables.AddGrowableCol(6)
         p_adjustables.SetSizer(sz_adjustables)
 
+        sz_job = wx.GridBagSizer(6, 6)
+        sz_job.Add(self.l_job, pos=(0, 0), flag=wx.ALL | wx.EXPAND, span=(1, 2))
+        sz_job.Add(self.g_job, pos=(1, 0), flag=wx.ALL | wx.EXPAND | wx.ALIGN_CENTER_VERTICAL)
+        sz_job.Add(self.b_job_cancel, pos=(1, 1), flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL)
+        sz_job.AddGrowableCol(0)
+        p_job.SetSizer(sz_job)
+
         sz_all = wx.BoxSizer(wx.VERTICAL)
         sz_all.Add(p_song, flag=wx.ALL | wx.EXPAND, border=12)
         sz_all.Add(p_chart_mapping, flag=wx.ALL | wx.EXPAND, border=12)
         sz_all.Add(p_adjustables, flag=wx.ALL | wx.EXPAND, border=12)
+        sz_all.Add(p_job, flag=wx.ALL | wx.EXPAND, border=12)
         sz_all.Add(self.b_go, 1, flag=wx.ALL | wx.EXPAND, border=12)
         p_all.SetSizer(sz_all)
 
@@ -186,14 +286,99 @@ class SaturdayMorning(wx.Frame):
 
     @except_decorator
     def OnClose(self, event):
+        if self.job is not None:
+            self.job.Cancel()
+            self.job.join()
+            self.job = None
         self.SaveDefaults()
         event.Skip()
 
 
     @except_decorator
     def OnConvert(self, event):
-        self.SaveSong()
-        self.Close()
+        settings = self.GatherSettings()
+        def work(job):
+            self.SaveSong(settings, job)
+        def on_done(job):
+            wx.MessageBox(job.Summary(), caption='Injected!', style=wx.OK | wx.ICON_INFORMATION | wx.CENTRE, parent=self)
+            self.Close()
+        self.StartJob('Injection', work, len(self.slots) + 1, on_done)
+
+
+    def GatherSettings(self, targets=True):
+        # Snapshot everything a conversion needs from the controls,
+        # so the worker thread never has to touch them. The preview
+        # doesn't need the target installs, so it can leave them out.
+        settings = {
+            'path': self.data['path'],
+            'itch': self.itch,
+            'song': self.c_song_choice.GetValue(),
+            'offset': self.s_offset.GetValue(),
+            'speed': self.s_speed.GetValue(),
+            'mapping': {s: (self.c_slot_opp[s].GetValue(), self.c_slot_plr[s].GetValue()) for s in self.slots}
+        }
+        if targets:
+            settings['targets'] = fnf_util.Targets(self.data)
+        return settings
+
+
+    def StartJob(self, title, work, n_stages, on_done=None):
+        if self.job is not None:
+            raise ValueError(f'Still busy with {self.job.title}!')
+        self.job = Job(self, title, work, n_stages, on_done)
+        self.g_job.SetRange(max(n_stages, 1))
+        self.g_job.SetValue(0)
+        self.l_job.SetLabel(f'{title}...')
+        self.EnableControls(False)
+        self.job.start()
+
+
+    def EnableControls(self, enable):
+        # Everything but Cancel stays locked while a job runs, since the
+        # job may be swapping out the charts the controls refer to.
+        controls = [self.b_go, self.b_song_source, self.b_path_to_exe, self.c_song_choice, self.s_offset, self.s_speed]
+        for s in self.slots:
+            controls += [self.c_slot_opp[s], self.c_slot_plr[s]]
+        for c in controls:
+            c.Enable(enable)
+        self.b_job_cancel.Enable(not enable)
+
+
+    def OnJobStage(self, job, i, label):
+        if job is not self.job:
+            return
+        self.g_job.SetValue(min(i, self.g_job.GetRange()))
+        self.l_job.SetLabel(f'{job.title}: {label}...')
+
+
+    def OnJobDone(self, job, exc_info):
+        if job is not self.job:
+            return
+        self.job = None
+        self.EnableControls(True)
+        self.g_job.SetValue(0)
+        if exc_info is not None:
+            if issubclass(exc_info[0], JobCancelled):
+                self.l_job.SetLabel(f'{job.title} cancelled.')
+            else:
+                self.l_job.SetLabel(f'{job.title} failed.')
+                ExceptMyFate(exc_info)
+            return
+        self.g_job.SetValue(self.g_job.GetRange())
+        self.l_job.SetLabel(job.Summary())
+        if job.on_done is not None:
+            try:
+                job.on_done(job)
+            except:
+                ExceptMyFate()
+
+
+    @except_decorator
+    def OnCancelJob(self, event):
+        if self.job is not None:
+            self.job.Cancel()
+            self.b_job_cancel.Disable()
+            self.l_job.SetLabel(f'Cancelling {self.job.title}...')
 
 
     @except_decorator
@@ -205,50 +390,84 @@ class SaturdayMorning(wx.Frame):
             self.c_song_choice.SetValue(self.songlist[0])
         if len(self.charts) > 0:
             slots_available = [s for s in self.charts]
-            for i, s in enumerate(self.slots):
-                i_plr = len(self.slots) - i - 1
-                i_plr = max(i_plr, 0)
-                i_plr = min(i_plr, len(slots_available)-1)
+            if len(self.metrics) == len(self.charts):
+                mapping = analytics_util.AutoMapping(self.metrics, self.slots)
+            else:
+                mapping = fnf_util.DefaultMapping(slots_available, self.slots)
+            for s in self.slots:
                 self.c_slot_opp[s].Set(slots_available)
-                self.c_slot_opp[s].SetValue(slots_available[0])
+                self.c_slot_opp[s].SetValue(mapping[s][0])
                 self.c_slot_plr[s].Set(slots_available)
-                self.c_slot_plr[s].SetValue(slots_available[i_plr])
+                self.c_slot_plr[s].SetValue(mapping[s][1])
+            self.SchedulePreview()
 
 
     @except_decorator
-    def LoadSonglist(self):
-        p = self.data['path']
-        self.songlist = []
-        if os.path.exists(p):
-            if os.path.exists(os.path.join(p, 'lime.ndll')):
-                p_sub = []
-                sl_sub = {}
-
-                if self.itch:
-                    for d_check in ['data', 'music']:
-                        p_sub = os.path.join(p, 'assets', d_check)
-                        p_backup = os.path.join(p, '_backup', d_check)
-                        sl_sub[d_check] = [n for n in os.listdir(p_sub)]
-                        if not os.path.isdir(p_backup):
-                            shutil.copytree(p_sub, p_backup)
-
-                    self.songlist = [n for n in sl_sub['data'] if f"{n.title()}_Inst.ogg" in sl_sub['music']]
-                else: 
-                    for d_check in ['data', 'songs']:
-                        p_sub = os.path.join(p, 'assets', d_check)
-                        p_backup = os.path.join(p, '_backup', d_check)
-                        sl_sub[d_check] = [n for n in os.listdir(p_sub)]
-                        if not os.path.isdir(p_backup):
-                            shutil.copytree(p_sub, p_backup)
-
-                    self.songlist = [n for n in sl_sub['data'] if n in sl_sub['songs']]
-            else:
-                raise ValueError(f"{os.path.join(p, 'Funkin.exe')} (FNF executable) not found")
+    def OnAdjust(self, event):
+        self.SchedulePreview()
+
+
+    def SchedulePreview(self, delay_ms=150):
+        # Debounce: spinning the offset fires a lot of events in a row.
+        if self.preview_timer is not None and self.preview_timer.IsRunning():
+            self.preview_timer.Start(delay_ms)
         else:
-            raise ValueError(f'Friday Night Funkin\' path "{p}" not found')
-    
+            self.preview_timer = wx.CallLater(delay_ms, self.UpdatePreview)
+
+
+    @except_decorator
+    def UpdatePreview(self):
+        if self.job is not None:
+            return                  # UpdateUI() schedules another once the job is done
+        if len(self.charts) == 0:
+            self.l_preview.SetLabel('')
+            return
+        settings = self.GatherSettings(targets=False)
+        pairings = set(settings['mapping'].values()) - set(self.compiled)
+        if len(pairings) > 0:
+            self.StartCompile(pairings)     # previews again when it's done
+            return
+        lines = []
+        for s in self.slots:
+            summary = fnf_util.SummarizeFNF(self.CompiledCharts(*settings['mapping'][s]), settings['offset'])
+            line = f"{s}: {summary['sections']} sections"
+            if summary['first_note'] is not None:
+                line += f", first note at {summary['first_note']:.3f} s"
+            if summary['bpm_min'] is not None:
+                line += f", section BPM {summary['bpm_min']:.1f} to {summary['bpm_max']:.1f}"
+            lines.append(line)
+            for e in summary['errors']:
+                lines.append(f'    !!! {e}')
+        if self.audio_fit is not None:
+            lines += [f'!!! {p}' for p in ogg_util.FitProblems(self.audio_fit, settings['offset'])]
+        self.l_preview.SetLabel('\n'.join(lines))
+        self.Layout()
+        self.Fit()
+
+
+    def StartCompile(self, pairings):
+        # Compile newly chosen opponent/player pairings off the main thread.
+        charts = self.charts
+        compiled = {}
+        def work(job):
+            for chart_opp_slot, chart_plr_slot in sorted(pairings):
+                job.Stage(f'{chart_opp_slot} vs. {chart_plr_slot}')
+                compiled[(chart_opp_slot, chart_plr_slot)] = fnf_util.CompileFNF(charts[chart_opp_slot], charts[chart_plr_slot])
+        def on_done(job):
+            if self.charts is charts:
+                self.compiled.update(compiled)
+            self.UpdatePreview()
+        self.StartJob('Compiling charts', work, len(pairings), on_done)
+
 
-    def SelectSimfile(self) -> int:
+    @except_decorator
+    def LoadSonglist(self, job=None):
+        self.songlist = []
+        self.songlist = fnf_util.ListSongs(self.data['path'], self.itch, job)
+
+
+    def SelectSimfile(self):
+        # The chosen simfile, checked, or None if the dialog was cancelled.
         fdlg_simfile = wx.FileDialog(
             self,
             message='Select the simfile to copy charts from',
@@ -256,66 +475,55 @@ class SaturdayMorning(wx.Frame):
             wildcard="Stepmania 5+ simfile (*.ssc)|*.ssc|StepMania 3.95 simfile (*.sm)|*.sm",
             style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST            
         )
-        result = fdlg_simfile.ShowModal()
-        if result == wx.ID_OK:
-            fn = fdlg_simfile.GetPath()
-            self.simfile = SaturdayMorning.CheckSimfile(fn)
-        return result
+        if fdlg_simfile.ShowModal() != wx.ID_OK:
+            return None
+        return fnf_util.CheckSimfile(fdlg_simfile.GetPath())
 
 
     @except_decorator
     def OnSelectSimfile(self, event):
-        if self.SelectSimfile() == wx.ID_OK:
-            self.LoadSimfile()
+        fn = self.SelectSimfile()
+        if fn is not None:
+            self.StartLoadSimfile(fn)
+
+
+    def StartLoadSimfile(self, fn):
+        # Everything is loaded into `loaded` off the main thread and only
+        # swapped in once the whole job has succeeded, so a bad or cancelled
+        # load leaves the previous simfile intact.
+        loaded = {'simfile': fn, 'compiled': {}}
+        def work(job):
+            job.Stage('Reading simfile')
+            loaded['charts'], loaded['name'] = self.LoadSimfile(fn)
+            job.Stage('Analyzing charts')
+            loaded['metrics'] = analytics_util.AnalyzeCharts(loaded['charts'])
+            job.Stage('Checking audio')
+            loaded['audio_fit'] = ogg_util.AudioFit(fn, loaded['charts'])
+            if len(loaded['charts']) > 0:
+                # So the first preview doesn't have to compile on the main thread.
+                job.Stage('Compiling charts')
+                for chart_opp_slot, chart_plr_slot in set(analytics_util.AutoMapping(loaded['metrics'], self.slots).values()):
+                    loaded['compiled'][(chart_opp_slot, chart_plr_slot)] = fnf_util.CompileFNF(loaded['charts'][chart_opp_slot], loaded['charts'][chart_plr_slot])
+        def on_done(job):
+            self.simfile = loaded['simfile']
+            self.charts = loaded['charts']
+            self.name = loaded['name']
+            self.metrics = loaded['metrics']
+            self.audio_fit = loaded['audio_fit']
+            self.compiled = loaded['compiled']
+            chart_util.CloseArchives()      # don't hold a .zip pack open until Go!
             self.UpdateUI()
+        self.StartJob('Loading simfile', work, 4, on_done)
 
 
-    @staticmethod
-    def CheckSimfile(fn):
-        if not os.path.exists(fn):
-            raise ValueError(f'Simfile or simfile directory does not exist: "{song_directory}"')
-
-        if os.path.isdir(fn):
-            # Accept drag/drop of a directory as well as a .sm or .ssc file
-            song_directory = fn
-            chart_files = [n for n in os.listdir(song_directory) if os.path.splitext(n)[1] == '.ssc']
-            if len(chart_files) == 0:
-                chart_files = [n for n in os.listdir(song_directory) if os.path.splitext(n)[1] == '.sm']
-            if len(chart_files) == 0:
-                raise ValueError(f'No .sm or .ssc files found in "{song_directory}"')
-            fn = os.path.join(song_directory, chart_files[0])
-        else:
-            if os.path.splitext(fn)[1] not in ['.ssc', '.sm']:
-                raise ValueError(f'The simfile provided did not have a .sm or .ssc extension: "{fn}"')
-            song_directory = os.path.dirname(fn)
-
-        audio_files = [n for n in os.listdir(song_directory) if os.path.splitext(n)[1] == '.ogg']
-        if len(audio_files) == 0:
-            raise ValueError(f'No .ogg files found in "{song_directory}" alongside simfile')
-
-        return fn
-
-
-    @except_decorator
-    def LoadSimfile(self):
-        self.name = ''
-        self.charts = {}
+    def LoadSimfile(self, fn):
+        # (charts, song name). Only the headers are read here; note data is
+        # parsed when a chart is converted.
+        charts = fnf_util.LoadCharts(fn)
         any_chart_info = None
-        for chart_slot in ['Challenge', 'Hard', 'Medium', 'Easy', 'Beginner']:
-            try:
-                parsed_chart, gimmick_data, chart_info = chart_util.ParseChartSM(self.simfile, chart_type='dance-single', chart_slot=chart_slot, shush=True)
-                self.charts[chart_slot] = {
-                    'chart': parsed_chart,
-                    'gimmick': gimmick_data,
-                    'info': chart_info
-                }
-                if any_chart_info is None:
-                    any_chart_info = chart_info
-                # print(f'Found a {chart_slot} chart in {chart_files[0]}')
-            except:
-                pass
-                # print(f'No {chart_slot} chart in {chart_files[0]}')
-        self.name = SaturdayMorning.BuildSongName(any_chart_info)
+        if len(charts) > 0:
+            any_chart_info = next(iter(charts.values()))['info']
+        return charts, fnf_util.BuildSongName(any_chart_info)
 
 
     @except_decorator
@@ -337,6 +545,7 @@ class SaturdayMorning(wx.Frame):
             self.data['silence'] = r'assets/silence.ogg'
         if 'speed' not in self.data:
             self.data['speed'] = 2.0
+        chart_util.SetChartLimits(self.data.get('limits'))
 
     
     @except_decorator
@@ -350,8 +559,20 @@ class SaturdayMorning(wx.Frame):
     @except_decorator
     def OnNavigateFunkinEXE(self, event):
         if self.LookupFunkinEXE() == wx.ID_OK:
-            self.LoadSonglist()
+            self.StartLoadSonglist()
+
+
+    def StartLoadSonglist(self, then=None):
+        # The first scan of an install also backs it up, which can take a
+        # while; then() runs on the main thread once the list is in.
+        def work(job):
+            job.Stage('Scanning songs')
+            self.LoadSonglist(job)
+        def on_done(job):
             self.UpdateUI()
+            if then is not None:
+                then()
+        self.StartJob('Loading song list', work, 3, on_done)
     
 
     def LookupFunkinEXE(self) -> int:
@@ -365,231 +586,50 @@ class SaturdayMorning(wx.Frame):
         result = fdlg_funkin.ShowModal()
         if result == wx.ID_OK:
             p = os.path.dirname(fdlg_funkin.GetPath())
-            self.itch = SaturdayMorning.CheckFunkinEXE(p)
+            self.itch = fnf_util.CheckFunkinEXE(p)
             self.data['path'] = p
         return result
 
 
-    @staticmethod
-    def CheckFunkinEXE(p) -> bool:
-        # Returns whether or not this install has an itch.io directory structure.
-        # Throws errors if it's not a valid install at all.
-        if not os.path.exists(p):
-            raise ValueError(f'Path to Funkin.exe does not exist: "{p}"')
-        if not os.path.exists(os.path.join(p, 'lime.ndll')):
-            raise ValueError(f'Path exists but does not appear to be a complete Friday Night Funkin\' install: "{p}"')
-        if not os.path.exists(os.path.join(p, 'assets', 'data')):
-            raise ValueError(f'Path to Funkin.exe exists but couldn\'t find the chart data subdirectory (/assets/data): "{p}"')
-        if os.path.exists(os.path.join(p, 'assets', 'songs')):
-            return False
-        elif os.path.exists(os.path.join(p, 'assets', 'music')):
-            return True
-        else:
-            raise ValueError(f'Path to Funkin.exe exists but couldn\'t find the song audio subdirectory (/assets/songs or /assets/music): "{p}"')
-
-
-    @staticmethod
-    def GetTimingEffects(gimmick_data):
-        offset = float(gimmick_data['OFFSET'])
-
-        bpm_list = []
-        stop_list = []
-        warp_list = []
-        
-        if len(gimmick_data['BPMS'].strip()) > 0:
-            bpm_events = gimmick_data['BPMS'].split(',')
-            bpm_list = [e.strip().split('=') for e in bpm_events]
-        if len(gimmick_data['STOPS'].strip()) > 0:
-            stop_events = gimmick_data['STOPS'].split(',')
-            stop_list = [e.strip().split('=') for e in stop_events]
-        if gimmick_data['WARPS'] is not None:
-            if len(gimmick_data['WARPS'].strip()) > 0:
-                warp_events = gimmick_data['WARPS'].split(',')
-                warp_list = [e.strip().split('=') for e in warp_events]
-
-        bpms = [(float(e[0]), float(e[1])) for e in bpm_list]
-        stops = [(float(e[0]), float(e[1])) for e in stop_list]
-        warps = [(float(e[0]), float(e[1])) for e in warp_list]
-
-        bpms.sort(key=lambda e: e[0])
-        stops.sort(key=lambda e: e[0])
-        warps.sort(key=lambda e: e[0])
-
-        bpms.append((1000000.0, bpms[-1][1]))   # Final BPM continues forever
-
-        return {
-            'offset': offset,
-            'bpms': bpms,
-            'stops': stops,
-            'warps': warps
-        }
-
-    @staticmethod
-    def B2T(timing, b, verbose=False, manual_offset=0.0):
-        offset = timing['offset']
-        bpms   = timing['bpms']
-        stops  = timing['stops']
-
-        t = -offset + manual_offset
-        for i in range(len(bpms)-1):
-            up_to = min(b, bpms[i+1][0])
-            dt = (up_to - bpms[i][0]) * 60 / bpms[i][1]
-            t += dt
-            if verbose:
-                print(f"b{bpms[i][0]:3.3f} -> b{up_to:3.3f}: take {dt:3.3f}")
-            if bpms[i+1][0] > b:
-                break
-        for s in stops:
-            if s[0] >= b:
-                break
-            if verbose:
-                print(f"b{s[0]:3.3f}: stop {s[1]:3.3f}")
-            t += s[1]
-        return t
-
-    @staticmethod
-    def CalculateTimes(chart_data, gimmick_data, manual_offset=0.0):
-        timing = SaturdayMorning.GetTimingEffects(gimmick_data)
-        for e in chart_data:
-            e['time'] = SaturdayMorning.B2T(timing, e['beat'], manual_offset=manual_offset)
-
-    @staticmethod
-    def CalculateHolds(chart_data):
-        for i, e in enumerate(chart_data):
-            if e['type'] in ['H', 'R']:
-                for potential_end in chart_data[i:]:
-                    if potential_end['type'] == 'E' and potential_end['lane'] == e['lane']:
-                        e['blen'] = potential_end['time'] - e['time']
-                        break
-
-    @staticmethod
-    def BuildSongName(chart_info):
-        name = chart_info['ARTIST']
-        if len(chart_info['ARTISTTRANSLIT'].strip()) != 0:
-            name += f" ({chart_info['ARTISTTRANSLIT']})"
-        name += ' - "'
-        name += chart_info['TITLE']
-        if len(chart_info['TITLETRANSLIT'].strip()) != 0:
-            name += f" ({chart_info['TITLETRANSLIT']})"
-        name += '"'
-        return name
-    
-
-    def ChartsToFNF(self, slot='Normal'):
-        manual_offset = self.s_offset.GetValue()
+    def CompiledCharts(self, chart_opp_slot, chart_plr_slot):
+        # Compiled once per opponent/player pairing; offset and speed are
+        # applied on top of this by EmitFNF() and SummarizeFNF().
+        key = (chart_opp_slot, chart_plr_slot)
+        if key not in self.compiled:
+            self.compiled[key] = fnf_util.CompileFNF(self.charts[chart_opp_slot], self.charts[chart_plr_slot])
+        return self.compiled[key]
 
-        chart_opp = deepcopy(self.charts[self.c_slot_opp[slot].GetValue()])
-        chart_plr = deepcopy(self.charts[self.c_slot_plr[slot].GetValue()])
 
-        beat_max = max(
-            [e['beat'] for e in chart_opp['chart']] +
-            [e['beat'] for e in chart_plr['chart']]
-        )
-        frame_notes = [[] for i in range(1 + int(beat_max) // 4)]
-
-        SaturdayMorning.CalculateTimes(chart_opp['chart'], chart_opp['gimmick'], manual_offset)
-        SaturdayMorning.CalculateTimes(chart_plr['chart'], chart_plr['gimmick'], manual_offset)
-        SaturdayMorning.CalculateHolds(chart_opp['chart'])
-        SaturdayMorning.CalculateHolds(chart_plr['chart'])
-
-        # bf in lanes 4-7
-        for e in chart_opp['chart']:
-            e['lane'] += 4
-
-        full_chart = chart_opp['chart'] + chart_plr['chart']
-        full_chart.sort(key=lambda e: e['beat'])
-
-        for e in full_chart:
-            if e['type'] in ['E', 'M']:
-                continue
-
-            f = int(e['beat'] / 4)
-            t     = e['time'] * 1000            # milliseconds
-            t_len = e.get('blen', 0) * 1000     # milliseconds
-
-            if e['type'] == 'T':
-                frame_notes[f].append([t, e['lane'], 0])
-            elif e['type'] in ['H', 'R']:
-                frame_notes[f].append([t, e['lane'], t_len])
-
-        # Convert to frame objects
-        frames = []
-        timing_plr = SaturdayMorning.GetTimingEffects(chart_plr['gimmick'])
-        for fi, fn in enumerate(frame_notes):
-            t_start = SaturdayMorning.B2T(timing_plr, fi*4, manual_offset=manual_offset)
-            t_end = SaturdayMorning.B2T(timing_plr, 4+fi*4, manual_offset=manual_offset)
-            if (t_end - t_start) < 0.001 and len(fn) > 0:
-                raise ValueError(f'Frame {fi} has {len(fn)} notes but spans {t_end-t_start:3.3f} seconds?')
-            measure = {
-                'lengthInSteps': 16,
-                'bpm': int(240 / (t_end - t_start)),
-                'changeBPM': False,
-                'mustHitSection': True,
-                'sectionNotes': [],
-                'typeOfSection': 0
-            }
-            measure['sectionNotes'] = fn
-            frames.append(measure)
-
-        # Let's use the DDR first-measure trick
-        full_offset = -timing_plr['offset'] + manual_offset
-        if full_offset > 0.001:                 # Add teeny initial measure
-            first_measure = {
-                'lengthInSteps': 1,
-                'bpm': -15 / full_offset,
-                'changeBPM': False,
-                'mustHitSection': True,
-                'sectionNotes': [],
-                'typeOfSection': 0
-            }
-            frames.insert(0, first_measure)
-        elif full_offset < 0.001:               # Shrink initial measure slightly
-            spm = 240 / frames[0]['bpm']
-            spm -= full_offset
-            frames[0]['bpm'] = 240 / spm
-
-        # Create full song JSON!
-        display_bpm = int(timing_plr['bpms'][0][1])
-        song_name = self.c_song_choice.GetValue().title()
-        song_dict = {
-            'song': {
-                'song': song_name,              # injecting rather than adding a new song oops
-                'notes': frames,
-                'bpm': display_bpm,
-                'sections': 0,
-                'needsVoices': False,
-                'player1': 'bf',
-                'player2': 'dad',               # TODO: Match character?
-                'sectionLengths': [],
-                'speed': self.s_speed.GetValue(),
-                'validScore': True
-            },
-            'bpm': display_bpm,
-            'sections': len(frames)
-        }
-
-        return song_dict
+    def ChartsToFNF(self, slot='Normal', settings=None):
+        # engine -> song JSON, for every engine the target installs use.
+        settings = settings or self.GatherSettings()
+        compiled = self.CompiledCharts(*settings['mapping'][slot])
+        engines = sorted(set(t['engine'] for t in settings['targets']))
+        return fnf_util.EmitEngines(compiled, engines, settings['offset'], settings['speed'], settings['song'].title())
 
 
     @except_decorator
-    def SaveSong(self):
-        path = self.data['path']
-        song = self.c_song_choice.GetValue()
-        simpath = os.path.dirname(self.simfile)
-        fn_audio = [fn for fn in os.listdir(simpath) if os.path.splitext(fn)[1] == '.ogg']
-        fn_audio = os.path.join(simpath, fn_audio[0])
+    def SaveSong(self, settings=None, job=None):
+        settings = settings or self.GatherSettings()
+        song = settings['song']
 
+        song_dicts = {}
         for s in self.slots:
-            song_dict = self.ChartsToFNF(s)
-            with open(os.path.join(path, 'assets/data', song, song + self.slots[s] + '.json'), 'w') as fp:
-                json.dump(song_dict, fp)
-        shutil.copy2(self.simfile, os.path.join(path, 'assets/data', song, song + '-source' + os.path.splitext(self.simfile)[1]))
-        if self.itch:
-            shutil.copy2(fn_audio, os.path.join(path, 'assets/music', f'{song.title()}_Inst.ogg'))
-            shutil.copy2(os.path.join(self.root, self.data['silence']), os.path.join(path, 'assets/music', f'{song.title()}_Voices.ogg'))
-        else:
-            shutil.copy2(fn_audio, os.path.join(path, 'assets/songs', song, 'Inst.ogg'))
-            shutil.copy2(os.path.join(self.root, self.data['silence']), os.path.join(path, 'assets/songs', song, 'Voices.ogg'))
+            if job is not None:
+                job.Stage(f'Converting {s}')
+            for engine, song_dict in self.ChartsToFNF(s, settings).items():
+                song_dicts.setdefault(engine, {})[s] = song_dict
+
+        if job is not None:
+            job.Stage('Writing files')
+        reports, errors = fnf_util.WriteTargets(settings['targets'], song, self.simfile, song_dicts, os.path.join(self.root, self.data['silence']), self.slots, job)
+        if job is not None:
+            for p, report in reports.items():
+                if len(reports) > 1:
+                    job.details.append(p)
+                job.details += [f"{os.path.basename(r['path'])}: {r['write_ms'] + r['sync_ms']:.0f} ms" for r in report]
+        if len(errors) > 0:
+            raise ValueError('Could not inject into every install:\n' + '\n'.join(errors))
 
 
 if __name__ == '__main__':
@@ -598,9 +638,10 @@ if __name__ == '__main__':
     frame = None
     app = wx.App()
     frame = SaturdayMorning(None, title="Saturday Morning Steppin' 0.3 (StepMania -> FNF)")
+    simfile = None
     if len(sys.argv) > 1:
-        frame.simfile = SaturdayMorning.CheckSimfile(sys.argv[1])
-        frame.LoadSimfile()
-        frame.UpdateUI()
+        simfile = fnf_util.CheckSimfile(sys.argv[1])
     frame.Show()
+    if 'path' in frame.data:
+        frame.StartLoadSonglist(simfile is not None and (lambda: frame.StartLoadSimfile(simfile)) or None)
     app.MainLoop()
@@ -0,0 +1,148 @@
+# analytics_util.py: Chart density metrics and automatic difficulty slot mapping
+# Copyright (C) 2021 Telperion (github.com/telperion)
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+
+# Every metric here is a single pass (or a two-pointer sweep) over the
+# chart's row beat/time arrays, so a whole pack can be analyzed at load.
+
+import chart_util
+import fnf_util
+
+NPS_WINDOW = 2.0            # seconds
+NPS_STEP = 0.5              # seconds between NPS curve samples
+STREAM_SPACING = 0.25       # beats between rows of a 16th stream
+STREAM_MIN_ROWS = 16        # rows in a row before it counts as a stream
+
+
+
+def ChartRows(chart_entry):
+    # Collapse the parsed notes into rows: parallel lists of row beat,
+    # row time, steps (taps/hold heads/roll heads) and mines per row.
+    timing = fnf_util.GetTimingEffects(chart_entry['gimmick'])
+    notes = fnf_util.DropSkippedNotes(chart_util.ChartNotes(chart_entry), timing)
+
+    beats = []
+    steps = []
+    mines = []
+    holds = 0
+    for e in notes:
+        is_step = e['type'] in ['T', 'H', 'R']
+        is_mine = e['type'] == 'M'
+        if not is_step and not is_mine:
+            continue
+        if e['type'] in ['H', 'R']:
+            holds += 1
+        if len(beats) == 0 or e['beat'] != beats[-1]:
+            beats.append(e['beat'])
+            steps.append(0)
+            mines.append(0)
+        steps[-1] += is_step
+        mines[-1] += is_mine
+
+    times = [fnf_util.B2T(timing, b) for b in beats]
+    return {'beats': beats, 'times': times, 'steps': steps, 'mines': mines, 'holds': holds}
+
+
+def NPSCurve(times, weights, window=NPS_WINDOW, step=NPS_STEP):
+    # Notes per second in [t, t + window) for t = first note, first note + step, ...
+    # Two pointers over the sorted times: O(rows + samples).
+    if len(times) == 0:
+        return []
+    curve = []
+    lo = 0
+    hi = 0
+    in_window = 0
+    t = times[0]
+    while t <= times[-1]:
+        while hi < len(times) and times[hi] < t + window:
+            in_window += weights[hi]
+            hi += 1
+        while lo < hi and times[lo] < t:
+            in_window -= weights[lo]
+            lo += 1
+        curve.append(in_window / window)
+        t += step
+    return curve
+
+
+def StreamRows(beats, steps):
+    # Rows that belong to unbroken 16th (or faster) runs of STREAM_MIN_ROWS or more.
+    stream = 0
+    run = 1
+    for i in range(1, len(beats) + 1):
+        if i < len(beats) and steps[i] > 0 and steps[i-1] > 0 and beats[i] - beats[i-1] <= STREAM_SPACING + 1e-6:
+            run += 1
+            continue
+        if run >= STREAM_MIN_ROWS:
+            stream += run
+        run = 1
+    return stream
+
+
+def ChartMetrics(chart_entry):
+    rows = ChartRows(chart_entry)
+    times = rows['times']
+    steps = rows['steps']
+    n_steps = sum(steps)
+    n_mines = sum(rows['mines'])
+
+    curve = NPSCurve(times, steps)
+    duration = (times[-1] - times[0]) if len(times) > 1 else 0.0
+    metrics = {
+        'meter': chart_entry['info']['METER'],
+        'steps': n_steps,
+        'nps_curve': curve,
+        'peak_nps': max(curve) if len(curve) > 0 else 0.0,
+        'avg_nps': (n_steps / duration) if duration > 0 else 0.0,
+        'hold_ratio': (rows['holds'] / n_steps) if n_steps > 0 else 0.0,
+        'mine_ratio': (n_mines / (n_steps + n_mines)) if n_steps + n_mines > 0 else 0.0,
+        'jumps': sum(1 for s in steps if s >= 2),
+        'stream_rows': StreamRows(rows['beats'], steps)
+    }
+    metrics['difficulty'] = ChartDifficulty(metrics)
+    return metrics
+
+
+def ChartDifficulty(metrics):
+    # A single number to rank charts by. Sustained density matters most;
+    # peaks, jumps and streams push it up a little.
+    jump_ratio = metrics['jumps'] / max(metrics['steps'], 1)
+    stream_ratio = metrics['stream_rows'] / max(metrics['steps'], 1)
+    return (0.6 * metrics['avg_nps'] + 0.4 * metrics['peak_nps']) * (1 + 0.5 * jump_ratio + 0.5 * stream_ratio)
+
+
+def AnalyzeCharts(charts):
+    # {chart slot: ChartMetrics()} for every chart loaded by fnf_util.LoadCharts().
+    return {c: ChartMetrics(charts[c]) for c in charts}
+
+
+def AutoMapping(metrics, slots=fnf_util.SLOTS):
+    # Player charts step up through the available charts from easiest to
+    # hardest as the FNF difficulty goes up; the opponent plays the next
+    # chart up from the player, so they're always showing off a little.
+    ranked = sorted(metrics, key=lambda c: (metrics[c]['difficulty'], metrics[c]['meter']))
+    if len(ranked) == 0:
+        return {}
+    mapping = {}
+    for i, s in enumerate(slots):
+        i_plr = 0
+        if len(slots) > 1:
+            i_plr = round(i * (len(ranked) - 1) / (len(slots) - 1))
+        i_opp = min(i_plr + 1, len(ranked) - 1)
+        mapping[s] = (ranked[i_opp], ranked[i_plr])
+    return mapping
@@ -18,9 +18,12 @@
 
 import re
 import io
+import math
 import os.path
+import threading
 
-import simfile
+# simfile is imported where it's used, so that scripts that only want
+# the note parsing helpers don't pay for it.
 
 _multitap_ver = 0.9
 
@@ -104,7 +107,46 @@ note_type_dict = {
 	'L': 'L'
 }
 
-def ParseNotesField(note_data, shush=True):
+class ChartLimitError(ValueError):
+	pass
+
+# Guards against simfiles that would otherwise take forever (or all the
+# memory there is) to parse or convert. Change them with SetChartLimits(),
+# or pass a dict of overrides as limits= to the functions that check them.
+ChartLimits = {
+	'rows_per_measure': 3072,	# 16x a 192nd-note measure
+	'lanes': 32,				# widest row; dance-double is 8, pump-double 10
+	'measures': 10000,
+	'beat': 40000.0,
+	'notes': 500000,
+	'min_bpm': 0.01				# absolute value; negative BPMs are a gimmick
+}
+
+def SetChartLimits(limits):
+	for k in (limits or {}):
+		if k not in ChartLimits:
+			raise ValueError(f'Unknown chart limit "{k}" (expected one of {", ".join(ChartLimits)})')
+	ChartLimits.update(limits or {})
+
+def ResolveLimits(limits=None):
+	if limits is None:
+		return ChartLimits
+	resolved = dict(ChartLimits)
+	resolved.update(limits)
+	return resolved
+
+def CheckLimit(limits, key, value, what):
+	if not math.isfinite(value):
+		raise ChartLimitError(f'{what} ({value}) is not a finite number')
+	if key == 'min_bpm':
+		if abs(value) < limits[key]:
+			raise ChartLimitError(f'{what} ({value}) is below the minimum of {limits[key]}')
+	elif value > limits[key]:
+		raise ChartLimitError(f'{what} ({value}) is over the limit of {limits[key]}')
+
+
+def ParseNotesField(note_data, shush=True, limits=None):
+	limits = ResolveLimits(limits)
 	parsedChart = []
 
 	currentMeasureNotes = []
@@ -114,9 +156,11 @@ def ParseNotesField(note_data, shush=True):
 
 	# print(note_data)
 	note_data = note_data.rstrip().rstrip(';') + '\n;'
-	for line in re.split('\n+', note_data):
+	for lineMatch in re.finditer('[^\n]+', note_data):
+		line = lineMatch.group(0)
 		if re.match('\s*[\,\;]\s*', line) is not None:
 			# print('End of measure!')
+			CheckLimit(limits, 'measures', currentMeasureNumber + 1, 'Measure count')
 			currentStartBeat = currentMeasureNumber * defaultBeatsPerMeasure
 			currentNoteIncrement = 0
 			if currentMeasureLength != 0:
@@ -128,6 +172,8 @@ def ParseNotesField(note_data, shush=True):
 				if not shush:
 					print('{} {} {} {}'.format(singleNote['beat'], singleNote['type'], singleNote['lane'], singleNote['qtzn']))
 				parsedChart.append(singleNote)
+			if len(currentMeasureNotes) > 0:
+				CheckLimit(limits, 'beat', currentMeasureNotes[-1]['beat'], 'Note beat')
 
 			currentMeasureNotes = []
 			currentMeasureNumber += 1
@@ -137,12 +183,15 @@ def ParseNotesField(note_data, shush=True):
 		if noteLine is not None:
 			notes = noteLine.group(1)
 			# print('>>> {}'.format(notes))
+			CheckLimit(limits, 'lanes', len(notes), f'Row width in measure {currentMeasureNumber}')
 
 			for laneIndex in range(len(notes)):
 				for nt_from, nt_to in note_type_dict.items():
 					if notes[laneIndex] == nt_from:
 						currentMeasureNotes.append({'tick': currentMeasureLength, 'type': nt_to, 'lane': laneIndex})
 			currentMeasureLength += 1
+			CheckLimit(limits, 'rows_per_measure', currentMeasureLength, f'Rows in measure {currentMeasureNumber}')
+			CheckLimit(limits, 'notes', len(parsedChart) + len(currentMeasureNotes), 'Note count')
 	
 	if not shush:
 		print('End of chart! ({} objects)'.format(len(parsedChart)))
@@ -229,10 +278,178 @@ def CalculateECFAScore(radar):
 	return mods['bigscale'] * ((S/mods['maxs']) ** mods['exp'])
 
 
+def SplitArchivePath(path):
+	# Paths can point inside a .zip pack, e.g. "C:/Packs/Pack.zip/Song/Song.ssc".
+	# Returns (archive, member) for those, with the member in zip "/" form
+	# ("" for the archive itself), or (None, path) for ordinary paths.
+	if os.path.exists(path) and not os.path.isfile(path):
+		return None, path
+	head = path
+	tail = []
+	while True:
+		if os.path.isfile(head):
+			if os.path.splitext(head)[1].lower() != '.zip':
+				return None, path
+			return head, '/'.join(reversed(tail))
+		parent, name = os.path.split(head)
+		if parent == head or len(name) == 0:
+			return None, path
+		tail.append(name)
+		head = parent
+
+
+_archive_cache = {}			# archive path -> [stamp, ZipFile, ListPack() listing], least recently used first
+_archive_lock = threading.Lock()
+ARCHIVE_CACHE_SIZE = 8
+
+def _ArchiveEntry(archive):
+	# One ZipFile (and so one read of the central directory) per archive,
+	# reopened only if the archive changes on disk. Past ARCHIVE_CACHE_SIZE
+	# archives the least recently used one is closed. Member files already
+	# opened from a closed ZipFile stay readable until they're closed too.
+	import zipfile
+	st = os.stat(archive)
+	key = os.path.abspath(archive)
+	stamp = (st.st_mtime_ns, st.st_size)
+	with _archive_lock:
+		entry = _archive_cache.pop(key, None)
+		if entry is not None and entry[0] != stamp:
+			entry[1].close()
+			entry = None
+		if entry is None:
+			entry = [stamp, zipfile.ZipFile(archive), None]
+		_archive_cache[key] = entry
+		while len(_archive_cache) > ARCHIVE_CACHE_SIZE:
+			_archive_cache.pop(next(iter(_archive_cache)))[1].close()
+		return entry
+
+def OpenArchive(archive):
+	return _ArchiveEntry(archive)[1]
+
+def CloseArchives(archive=None):
+	# Drop one cached archive, or all of them, e.g. so a pack can be
+	# replaced or deleted while the program is still running.
+	with _archive_lock:
+		keys = list(_archive_cache) if archive is None else [os.path.abspath(archive)]
+		for key in keys:
+			entry = _archive_cache.pop(key, None)
+			if entry is not None:
+				entry[1].close()
+
+
+def ListPack(archive):
+	# {song directory: {'simfiles': [...], 'audio': [...]}} for every directory
+	# in the archive that holds either, straight from the central directory.
+	entry = _ArchiveEntry(archive)
+	if entry[2] is None:
+		listing = {}
+		for info in entry[1].infolist():
+			if info.is_dir():
+				continue
+			d, n = info.filename.rsplit('/', 1) if '/' in info.filename else ('', info.filename)
+			ext = os.path.splitext(n)[1].lower()
+			if ext in ['.ssc', '.sm']:
+				listing.setdefault(d, {'simfiles': [], 'audio': []})['simfiles'].append(n)
+			elif ext == '.ogg':
+				listing.setdefault(d, {'simfiles': [], 'audio': []})['audio'].append(n)
+		entry[2] = listing
+	return entry[2]
+
+
+def OpenBinary(path):
+	# A readable binary file object for a plain path or a path inside a pack.
+	archive, member = SplitArchivePath(path)
+	if archive is None:
+		return io.open(path, mode='rb')
+	return OpenArchive(archive).open(member)
+
+
+def ReadMusicTag(chart_filename):
+	# The song-wide #MUSIC of a simfile (or None), found without parsing it.
+	with OpenBinary(chart_filename) as fp:
+		raw = fp.read()
+	first_chart = re.search(rb'#NOTE', raw)
+	m = re.search(rb'#MUSIC\s*:([^;]*);', raw[:first_chart.start()] if first_chart else raw)
+	if m is None or len(m.group(1).strip()) == 0:
+		return None
+	for encoding in ['utf-8', 'cp1252']:
+		try:
+			return m.group(1).decode(encoding).strip()
+		except UnicodeDecodeError:
+			pass
+	return None
+
+
+def OpenSimfile(chart_filename):
+	import simfile
+	archive, member = SplitArchivePath(chart_filename)
+	if archive is None:
+		return simfile.open(chart_filename)
+
+	raw = OpenArchive(archive).read(member)
+	encodings = getattr(simfile, 'ENCODINGS', ['utf-8', 'cp1252', 'cp932', 'cp949'])
+	for encoding in encodings:
+		try:
+			return simfile.loads(raw.decode(encoding))
+		except UnicodeDecodeError:
+			pass
+	raise ValueError(f'Could not decode "{chart_filename}" as any of {encodings}')
+
+
+def ChartHeadersSM(song_data, chart_data, ext):
+	# Pull the song/chart metadata and timing gimmicks for one chart,
+	# without touching its note data.
+	title = song_data.title
+	title_tl = song_data.titletranslit
+	artist = song_data.artist
+	artist_tl = song_data.artisttranslit
+	diff = int(chart_data.meter)
+	ext = ext.lower()
+	if ext == '.sm':
+		chart_author = chart_data.description
+		chart_style = ""
+	else:
+		chart_author = chart_data.get('CREDIT', 
+					   chart_data.get('DESCRIPTION',
+					   chart_data.get('CHARTNAME', "")))
+		chart_style = chart_data.get('CHARTSTYLE', "")
+	
+	chart_info = {
+		'TITLE': title,
+		'TITLETRANSLIT': title_tl,
+		'ARTIST': artist,
+		'ARTISTTRANSLIT': artist_tl,
+		'METER': diff,
+		'CREDIT': chart_author
+	}
+
+	gimmick_data = {
+		'OFFSET':   song_data.offset,
+		'BPMS':     song_data.bpms,
+		'STOPS':    song_data.stops,
+		'DELAYS':   getattr(song_data, 'delays', ''),
+		'WARPS':    getattr(song_data, 'warps', ''),
+		'SPEEDS':   getattr(song_data, 'speeds', '0.000=1.000=0.000=0'),
+		'SCROLLS':  getattr(song_data, 'scrolls', '0.000=1.000'),
+		'FAKES':    getattr(song_data, 'fakes', '')
+	}
+	
+	if ext == '.ssc':
+		gimmick_overwrites = [f for f in gimmick_data if f in chart_data]
+		if len(gimmick_overwrites) > 0:
+			for f in gimmick_data:
+				gimmick_data[f] = chart_data[f]
+		# gimmick_data['RADAR'] = TechRadarFromSteps(chart_data)
+		# gimmick_data['ECFA'] = CalculateECFAScore(gimmick_data['RADAR'])
+
+	return gimmick_data, chart_info
+
+
 def ParseChartSM(chart_filename, chart_type=None, chart_slot=None, chart_name=None, shush=True):
 	stem, ext = os.path.splitext(chart_filename)
+	ext = ext.lower()
 	if ext == '.sm' or ext == '.ssc':
-		song_data = simfile.open(chart_filename)
+		song_data = OpenSimfile(chart_filename)
 		chart_options = [c for c in song_data.charts if 
 							(chart_slot is None or c.difficulty.lower() == chart_slot.lower()) and
 							(chart_type is None or c.stepstype.lower()  == chart_type.lower())]
@@ -242,52 +459,66 @@ def ParseChartSM(chart_filename, chart_type=None, chart_slot=None, chart_name=No
 			raise ValueError(f"Found more than one {chart_type or '<n/a type>'} {chart_slot or '<n/a slot>'} in {chart_filename}!")
 
 		chart_data = chart_options.pop()
+		gimmick_data, chart_info = ChartHeadersSM(song_data, chart_data, ext)
 
-		title = song_data.title
-		title_tl = song_data.titletranslit
-		artist = song_data.artist
-		artist_tl = song_data.artisttranslit
-		diff = int(chart_data.meter)
-		if ext == '.sm':
-			chart_author = chart_data.description
-			chart_style = ""
-		else:
-			chart_author = chart_data.get('CREDIT', 
-						   chart_data.get('DESCRIPTION',
-						   chart_data.get('CHARTNAME', "")))
-			chart_style = chart_data.get('CHARTSTYLE', "")
-		
-		chart_info = {
-			'TITLE': title,
-			'TITLETRANSLIT': title_tl,
-			'ARTIST': artist,
-			'ARTISTTRANSLIT': artist_tl,
-			'METER': diff,
-			'CREDIT': chart_author
-		}
+	parsedChart = ParseNotesField(chart_data.notes, shush=shush)
+
+	return parsedChart, gimmick_data, chart_info
+
+
+def LoadChartsSM(chart_filename, chart_type=None, chart_slots=None):
+	# Open the simfile once and collect every chart that's uniquely identified
+	# by its slot. Note data is kept as the raw #NOTES string; call ChartNotes()
+	# to parse it the first time it's actually needed.
+	stem, ext = os.path.splitext(chart_filename)
+	ext = ext.lower()
+	if ext != '.sm' and ext != '.ssc':
+		raise ValueError(f'The simfile provided did not have a .sm or .ssc extension: "{chart_filename}"')
+
+	song_data = OpenSimfile(chart_filename)
+	chart_options = {}
+	for c in song_data.charts:
+		if chart_type is not None and c.stepstype.lower() != chart_type.lower():
+			continue
+		chart_options.setdefault(c.difficulty.lower(), []).append(c)
 
-		gimmick_data = {
-			'OFFSET':   song_data.offset,
-			'BPMS':     song_data.bpms,
-			'STOPS':    song_data.stops,
-			'DELAYS':   getattr(song_data, 'delays', ''),
-			'WARPS':    getattr(song_data, 'warps', ''),
-			'SPEEDS':   getattr(song_data, 'speeds', '0.000=1.000=0.000=0'),
-			'SCROLLS':  getattr(song_data, 'scrolls', '0.000=1.000'),
-			'FAKES':    getattr(song_data, 'fakes', '')
+	charts = {}
+	for chart_slot in (chart_slots or [c.difficulty for c in song_data.charts]):
+		matches = chart_options.get(chart_slot.lower(), [])
+		if len(matches) != 1:
+			continue
+		try:
+			gimmick_data, chart_info = ChartHeadersSM(song_data, matches[0], ext)
+		except ValueError:
+			continue					# e.g. a blank or non-numeric meter; skip just this chart
+		charts[chart_slot] = {
+			'notes': matches[0].notes,
+			'gimmick': gimmick_data,
+			'info': chart_info
 		}
-		
-		if ext == '.ssc':
-			gimmick_overwrites = [f for f in gimmick_data if f in chart_data]
-			if len(gimmick_overwrites) > 0:
-				for f in gimmick_data:
-					gimmick_data[f] = chart_data[f]
-			# gimmick_data['RADAR'] = TechRadarFromSteps(chart_data)
-			# gimmick_data['ECFA'] = CalculateECFAScore(gimmick_data['RADAR'])
 
-	parsedChart = ParseNotesField(chart_data.notes, shush=shush)
+	return charts
 
-	return parsedChart, gimmick_data, chart_info
+
+def LastNoteBeat(note_data):
+	# Beat of the last step, hold/roll head or hold end (not mines, lifts or
+	# fakes), looking back from the end of the note data only as far as the
+	# last measure that has one. Measures and rows count as in ParseNotesField().
+	ends = [m.start() for m in re.finditer('(?m)^[^\\S\\n]*[,;]', note_data)] + [len(note_data)]
+	for mi in range(len(ends) - 1, -1, -1):
+		start = ends[mi-1] if mi > 0 else 0
+		rows = re.findall('(?m)^\\s*([0-9FLM]+)', note_data[start:ends[mi]])
+		for ri in range(len(rows) - 1, -1, -1):
+			if any(n in rows[ri] for n in '1234'):
+				return mi * 4 + ri * 4 / len(rows)
+	return None
+
+
+def ChartNotes(chart_entry, shush=True, limits=None):
+	# Parse (and remember) the note data of a chart loaded by LoadChartsSM().
+	if 'chart' not in chart_entry:
+		chart_entry['chart'] = ParseNotesField(chart_entry['notes'], shush=shush, limits=limits)
+	return chart_entry['chart']
 
 
 
@@ -527,27 +758,134 @@ def ParseChartBMS(chartFilename):
 
 
 
+LuaFormats = {
+	'SM': {
+		'header': [
+			'-- [1]: beat number, zero at start',
+			'-- [2]: lane number, one-indexed',
+			'-- [3]: note type: Tap, Hold, Roll, End, or Mine',
+			'-- [4]: quantization reciprocal',
+		],
+		'row': lambda n: '\t{%11.6f, %d, "%s", %3d},' % (n['beat'], n['lane'] + 1, n['type'], n['qtzn']),
+		'sorted': True			# ParseNotesField output is already in beat order
+	},
+	'BMS': {
+		'header': [
+			'-- [1]: beat number, zero at start',
+			'-- [2]: lane number, one-indexed',
+			'-- [3]: note type: Tap, Hold, or End',
+			'-- [4]: keysound index',
+		],
+		'row': lambda n: '\t{%11.6f, "%s", "%s", "%s"},' % (n['beat'], n['lane'], n['type'], n['ksnd']),
+		'sorted': False			# ParseChartBMS output is grouped by channel
+	}
+}
+
+
+class _LuaWriter:
+	# Path, file-like object, or None (stdout), written through one buffer.
+	def __init__(self, out):
+		self.out = out
+		self.fp = None
+
+	def __enter__(self):
+		if self.out is None:
+			import sys
+			self.fp = sys.stdout
+		elif isinstance(self.out, (str, bytes, os.PathLike)):
+			self.fp = io.open(self.out, mode='w', encoding='utf-8', buffering=1 << 16)
+		else:
+			self.fp = self.out
+		return self.fp
+
+	def __exit__(self, *exc):
+		if self.fp is not self.out and self.out is not None:
+			self.fp.close()
+		else:
+			self.fp.flush()
+
+
+def _LuaChartBlock(parsedChart, fmt, name, presorted):
+	spec = LuaFormats[fmt]
+	if not (presorted or spec['sorted']):
+		parsedChart = sorted(parsedChart, key=lambda item: item['beat'])
+	row = spec['row']
+	lines = [f'local {name} = {{'] + ['\t' + h for h in spec['header']] + ['\t']
+	lines += [row(n) for n in parsedChart]
+	lines.append('}')
+	return '\n'.join(lines) + '\n'
+
+
+def ExportChartForLua(parsedChart, out=None, fmt='SM', presorted=False, name='ChartData'):
+	# Write one chart as a Lua table (for NotITG mod scripts and the like).
+	# out can be a path, any writable text file object, or None for stdout.
+	# Pass presorted=True if the notes are already in beat order.
+	with _LuaWriter(out) as fp:
+		fp.write(_LuaChartBlock(parsedChart, fmt, name, presorted))
+
+
+def LuaChartName(chart):
+	# "ChartData_dance_single_Challenge" and so on: a valid Lua identifier.
+	return re.sub(r'\W', '_', f'ChartData_{chart.stepstype}_{chart.difficulty}')
+
+
+def ExportSimfileForLua(chart_filename, out=None, chart_type=None):
+	# Every chart in a simfile (or only those of one chart_type), one table each.
+	song_data = OpenSimfile(chart_filename)
+	blocks = []
+	names = set()
+	for c in song_data.charts:
+		if chart_type is not None and c.stepstype.lower() != chart_type.lower():
+			continue
+		name = LuaChartName(c)
+		while name in names:
+			name += '_'
+		names.add(name)
+		blocks.append(f'-- {c.stepstype} {c.difficulty} {c.meter}\n')
+		blocks.append(_LuaChartBlock(ParseNotesField(c.notes), 'SM', name, True))
+	with _LuaWriter(out) as fp:
+		fp.write(''.join(blocks))
+	return len(names)
+
+
+def PackSimfiles(pack_path):
+	# One simfile per song directory (.ssc preferred over .sm) in a pack
+	# directory or .zip pack.
+	archive, member = SplitArchivePath(pack_path)
+	found = {}
+	if archive is None:
+		for d, subdirs, files in os.walk(pack_path):
+			found[d] = [os.path.join(d, f) for f in files if os.path.splitext(f)[1].lower() in ['.ssc', '.sm']]
+	else:
+		prefix = member and (member + '/')
+		for d, entry in ListPack(archive).items():
+			if d.startswith(prefix) or d == member:
+				found[d] = [os.path.join(archive, *(d.split('/') + [f])) for f in entry['simfiles']]
+	simfiles = []
+	for d in sorted(found):
+		preferred = [f for f in found[d] if f.lower().endswith('.ssc')] or found[d]
+		if len(preferred) > 0:
+			simfiles.append(sorted(preferred)[0])
+	return simfiles
+
+
+def ExportPackForLua(pack_path, out_dir, chart_type=None):
+	# ExportSimfileForLua() for every song in a pack, into out_dir/<song>.lua.
+	os.makedirs(out_dir, exist_ok=True)
+	exported = []
+	for fn in PackSimfiles(pack_path):
+		song = os.path.basename(os.path.dirname(fn)) or os.path.splitext(os.path.basename(fn))[0]
+		out = os.path.join(out_dir, re.sub(r'[<>:"/\\|?*]', '_', song) + '.lua')
+		ExportSimfileForLua(fn, out, chart_type=chart_type)
+		exported.append(out)
+	return exported
+
+
 def PrettifyChartForLuaSM(parsedChart):
-	print('local ChartData = {')
-	print('\t-- [1]: beat number, zero at start')
-	print('\t-- [2]: lane number, one-indexed')
-	print('\t-- [3]: note type: Tap, Hold, Roll, End, or Mine')
-	print('\t-- [4]: quantization reciprocal')
-	print('\t')
-	for singleNote in parsedChart:
-		print('\t{{{:>11.6f}, {:d}, "{}", {:>3d}}},'.format(singleNote['beat'], singleNote['lane'] + 1, singleNote['type'], singleNote['qtzn']))
-	print('}')
+	ExportChartForLua(parsedChart, fmt='SM', presorted=True)
 
 def PrettifyChartForLuaBMS(parsedChart):
-	print('local ChartData = {')
-	print('\t-- [1]: beat number, zero at start')
-	print('\t-- [2]: lane number, one-indexed')
-	print('\t-- [3]: note type: Tap, Hold, or End')
-	print('\t-- [4]: keysound index')
-	print('\t')
-	for singleNote in sorted(parsedChart, key=lambda item: item['beat']):
-		print('\t{{{:>11.6f}, "{}", "{}", "{}"}},'.format(singleNote['beat'], singleNote['lane'], singleNote['type'], singleNote['ksnd']))
-	print('}')
+	ExportChartForLua(parsedChart, fmt='BMS')
 
 
 def CompareCharts(fn1, fn2):
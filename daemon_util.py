@@ -0,0 +1,347 @@
+# daemon_util.py: Long-running conversion service with warm caches
+# Copyright (C) 2021 Telperion (github.com/telperion)
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+
+# Endpoints (JSON in, JSON out; every reply has "ok" and per-stage "timings" in ms):
+#
+#   POST /convert   {"simfile", "offset"?, "speed"?, "engine"?, "mapping"?, "full"?}
+#                   -> chart mapping, a summary per difficulty slot, and
+#                      any charts that run past the end of the audio
+#                      (plus the song JSONs themselves if "full" is true)
+#   POST /inject    {"simfile", "song", "offset"?, "speed"?, "engine"?, "mapping"?, "path"?}
+#                   -> per-file write report for every target install
+#   POST /diff      {"song", "path"?}
+#                   -> verify_util.VerifySong() of an injected song
+#   GET  /index     ?path=...
+#                   -> songs available to replace in an install
+#   GET  /stats     -> cache sizes and hit rates
+#
+# POST bodies must be sent as Content-Type: application/json, and requests
+# with an Origin header (i.e. from a web page) are refused.
+# "path" defaults to the install (and "targets") in the defaults JSON;
+# slots left out of "mapping" default to analytics_util.AutoMapping().
+#
+# Simfiles are cached by path, modification time and size, so saving one
+# is enough to make the next request see the new charts.
+
+
+import os
+import json
+import time
+import argparse
+import threading
+import traceback
+import http.server
+import socketserver
+import urllib.parse
+from collections import OrderedDict
+
+import chart_util
+import fnf_util
+import analytics_util
+import verify_util
+import ogg_util
+
+DEFAULT_PORT = 8417
+
+
+
+class LRUCache:
+    """
+    A thread-safe map that forgets its least recently used entries past a
+    fixed size. Values are built by the loader passed to Get() on a miss;
+    two threads missing the same key at once may both build it.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def Get(self, key, loader):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = loader()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return value
+
+    def Stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses}
+
+
+def FileKey(fn):
+    # Changes whenever the file (or the .zip pack it's in) is saved.
+    archive, member = chart_util.SplitArchivePath(fn)
+    st = os.stat(archive or fn)
+    return (os.path.abspath(fn), st.st_mtime_ns, st.st_size)
+
+
+def DirKey(*paths):
+    return tuple((p, os.stat(p).st_mtime_ns) for p in paths)
+
+
+class ConversionDaemon:
+    """
+    Everything the endpoints share: the defaults JSON and the caches of
+    parsed simfiles, compiled charts (timing tables, timed notes and
+    section BPMs) and install song lists.
+    """
+
+    def __init__(self, data, root, simfiles=32, compiled=256, installs=8):
+        self.data = data
+        self.root = root
+        self.slots = dict(fnf_util.SLOTS)
+        self.silence = os.path.join(root, data.get('silence', r'assets/silence.ogg'))
+        self.simfiles = LRUCache(simfiles)
+        self.compiled = LRUCache(compiled)
+        self.installs = LRUCache(installs)
+
+    def Simfile(self, simfile):
+        # (simfile path, cache key, {'charts', 'mapping'})
+        fn = fnf_util.CheckSimfile(simfile)
+        key = FileKey(fn)
+        def load():
+            charts = fnf_util.LoadCharts(fn)
+            if len(charts) == 0:
+                raise ValueError(f'No dance-single charts found in "{fn}"')
+            return {
+                'charts': charts,
+                'mapping': analytics_util.AutoMapping(analytics_util.AnalyzeCharts(charts), self.slots),
+                'audio_fit': ogg_util.AudioFit(fn, charts)
+            }
+        return fn, key, self.simfiles.Get(key, load)
+
+    def Compiled(self, key, entry, chart_opp_slot, chart_plr_slot):
+        charts = entry['charts']
+        for c in [chart_opp_slot, chart_plr_slot]:
+            if c not in charts:
+                raise ValueError(f'No {c} chart (expected one of {", ".join(charts)})')
+        return self.compiled.Get(key + (chart_opp_slot, chart_plr_slot), lambda: fnf_util.CompileFNF(charts[chart_opp_slot], charts[chart_plr_slot]))
+
+    def Index(self, path, itch, job=None):
+        # The songs an install has to replace, rescanned when its
+        # chart or audio directory changes.
+        p_audio = os.path.join(path, 'assets', itch and 'music' or 'songs')
+        key = (os.path.abspath(path),) + DirKey(os.path.join(path, 'assets', 'data'), p_audio)
+        return self.installs.Get(key, lambda: fnf_util.ListSongs(path, itch, job))
+
+    def Targets(self, req):
+        if 'path' in req:
+            return fnf_util.Targets({'path': req['path'], 'engine': self.data.get('engine', fnf_util.DEFAULT_ENGINE)}, req.get('engine'))
+        if 'path' not in self.data:
+            raise ValueError('No "path" in the request or the defaults JSON')
+        return fnf_util.Targets(self.data, req.get('engine'))
+
+    def Convert(self, req, timings, engines):
+        # engine -> slot -> song JSON, plus the mapping, slot summaries
+        # and any charts that run past the end of the audio.
+        t = time.perf_counter()
+        fn, key, entry = self.Simfile(req['simfile'])
+        mapping = req.get('mapping', {})
+        if not isinstance(mapping, dict) or any(not isinstance(v, (list, tuple)) or len(v) != 2 for v in mapping.values()):
+            raise ValueError('"mapping" must be {slot: [opponent chart, player chart], ...}')
+        mapping = dict(entry['mapping'], **{s: tuple(v) for s, v in mapping.items()})    # slots left out are auto-mapped
+        t = Lap(timings, 'load', t)
+
+        offset = float(req.get('offset', 0.0))
+        speed = float(req.get('speed', self.data.get('speed', 2.0)))
+        song_name = req.get('song', '').title()
+        song_dicts = {e: {} for e in engines}
+        summaries = {}
+        for s in self.slots:
+            compiled = self.Compiled(key, entry, *mapping[s])
+            for e, song_dict in fnf_util.EmitEngines(compiled, engines, offset, speed, song_name).items():
+                song_dicts[e][s] = song_dict
+            summaries[s] = fnf_util.SummarizeFNF(compiled, offset)
+        audio = ogg_util.FitProblems(entry['audio_fit'], offset)
+        t = Lap(timings, 'convert', t)
+        return fn, mapping, song_dicts, summaries, audio
+
+    def HandleConvert(self, req, timings):
+        engines = [req.get('engine', self.data.get('engine', fnf_util.DEFAULT_ENGINE))]
+        fn, mapping, song_dicts, summaries, audio = self.Convert(req, timings, engines)
+        reply = {'simfile': fn, 'mapping': mapping, 'summaries': summaries, 'audio': audio}
+        if req.get('full', False):
+            reply['songs'] = song_dicts[engines[0]]
+        return reply
+
+    def HandleInject(self, req, timings):
+        t = time.perf_counter()
+        targets = self.Targets(req)
+        t = Lap(timings, 'targets', t)
+        engines = sorted(set(target['engine'] for target in targets))
+        fn, mapping, song_dicts, summaries, audio = self.Convert(req, timings, engines)
+
+        t = time.perf_counter()
+        reports, errors = fnf_util.WriteTargets(targets, req['song'], fn, song_dicts, self.silence, self.slots, list_songs=self.Index)
+        Lap(timings, 'write', t)
+        return {'simfile': fn, 'mapping': mapping, 'reports': reports, 'errors': errors, 'audio': audio}
+
+    def Path(self, req):
+        path = req.get('path', self.data.get('path'))
+        if path is None:
+            raise ValueError('No "path" in the request or the defaults JSON')
+        return path
+
+    def HandleDiff(self, req, timings):
+        t = time.perf_counter()
+        path = self.Path(req)
+        result = verify_util.VerifySong(path, req['song'], self.slots, self.data.get('limits'))
+        Lap(timings, 'diff', t)
+        return result
+
+    def HandleIndex(self, req, timings):
+        t = time.perf_counter()
+        path = self.Path(req)
+        itch = fnf_util.CheckFunkinEXE(path)
+        songs = self.Index(path, itch)
+        Lap(timings, 'index', t)
+        return {'path': path, 'itch': itch, 'songs': songs}
+
+    def HandleStats(self, req, timings):
+        return {'simfiles': self.simfiles.Stats(), 'compiled': self.compiled.Stats(), 'installs': self.installs.Stats()}
+
+
+def Lap(timings, label, t0):
+    t = time.perf_counter()
+    timings[label] = timings.get(label, 0.0) + (t - t0) * 1000
+    return t
+
+
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    ROUTES = {
+        ('POST', '/convert'): ConversionDaemon.HandleConvert,
+        ('POST', '/inject'): ConversionDaemon.HandleInject,
+        ('POST', '/diff'): ConversionDaemon.HandleDiff,
+        ('GET', '/index'): ConversionDaemon.HandleIndex,
+        ('GET', '/stats'): ConversionDaemon.HandleStats,
+    }
+
+    def Handle(self, method):
+        t_start = time.perf_counter()
+        timings = {}
+        url = urllib.parse.urlparse(self.path)
+        handler = self.ROUTES.get((method, url.path))
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if handler is None:
+            reply = {'ok': False, 'error': f'No {method} {url.path}'}
+            code = 404
+        elif 'Origin' in self.headers or (method == 'POST' and content_type != 'application/json'):
+            # Web pages can send simple cross-site requests to localhost, but
+            # can't do either of these without a CORS preflight we never answer.
+            reply = {'ok': False, 'error': 'Requests must come from a local client, with Content-Type: application/json'}
+            code = 403
+        else:
+            try:
+                if method == 'POST':
+                    length = int(self.headers.get('Content-Length', 0))
+                    req = json.loads(self.rfile.read(length) or b'{}')
+                else:
+                    req = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+                if not isinstance(req, dict):
+                    raise ValueError('Request body must be a JSON object')
+                reply = handler(self.server.daemon, req, timings)
+                reply['ok'] = True
+                code = 200
+            except (ValueError, KeyError, OSError) as e:
+                reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+                code = 400
+            except Exception as e:
+                # A bug rather than a bad request, but the client still gets a reply.
+                self.log_error('%s %s failed: %s', method, url.path, traceback.format_exc())
+                reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+                code = 500
+        timings['total'] = (time.perf_counter() - t_start) * 1000
+        reply['timings'] = timings
+        self.Reply(code, reply)
+
+    def Reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.Handle('GET')
+
+    def do_POST(self):
+        self.Handle('POST')
+
+    def address_string(self):
+        # Unix socket clients don't have a (host, port) address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)          # left over from a previous run
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def MakeServer(daemon, port=DEFAULT_PORT, unix_socket=None):
+    # Only ever listens locally: 127.0.0.1 or a Unix socket.
+    if unix_socket is not None:
+        server = ThreadingUnixHTTPServer(unix_socket, DaemonRequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), DaemonRequestHandler)
+    server.daemon = daemon
+    return server
+
+
+if __name__ == '__main__':
+    root = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Keep simfiles and FNF installs warm in memory and convert on request.")
+    parser.add_argument('--defaults', default=os.path.join(root, 'assets', 'SaturdayMorning_defaults.json'))
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='localhost port to listen on')
+    parser.add_argument('--socket', default=None, help='listen on this Unix socket instead')
+    parser.add_argument('--simfiles', type=int, default=32, help='parsed simfiles to keep')
+    args = parser.parse_args()
+
+    data = {}
+    if os.path.exists(args.defaults):
+        with open(args.defaults, 'r') as fp:
+            data = json.load(fp)
+    chart_util.SetChartLimits(data.get('limits'))
+
+    daemon = ConversionDaemon(data, root, simfiles=args.simfiles)
+    server = MakeServer(daemon, args.port, args.socket)
+    print(f"Listening on {args.socket or f'http://127.0.0.1:{args.port}'}; Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,901 @@
+# fnf_util.py: StepMania -> Friday Night Funkin' conversion, without the GUI
+# Copyright (C) 2021 Telperion (github.com/telperion)
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+
+# No source code for Friday Night Funkin' is included here.
+# For more information on its license, please check out their source:
+# https://github.com/KadeDev/Kade-Engine
+
+
+# Everything here is safe to import from scripts: no wx, and simfile is
+# only imported (by chart_util) once a simfile is actually opened.
+# Import budget: importing this module must stay under IMPORT_BUDGET_MS.
+# Check it with `python fnf_util.py --timings ...` or
+# `python -X importtime -c "import fnf_util"`.
+
+import time
+_t_import_start = time.perf_counter()
+
+import os
+import math
+import bisect
+import sys
+import json
+import io
+import shutil
+from copy import deepcopy
+
+import chart_util
+
+IMPORT_BUDGET_MS = 50
+
+SLOTS = {'Easy': '-easy', 'Normal': '', 'Hard': '-hard'}
+CHART_SLOTS = ['Challenge', 'Hard', 'Medium', 'Easy', 'Beginner']
+
+
+
+def ListSongDirectory(song_directory):
+    # Names of the simfiles and .ogg files directly inside a song directory,
+    # which may also be a directory inside a .zip pack.
+    archive, member = chart_util.SplitArchivePath(song_directory)
+    if archive is None:
+        names = os.listdir(song_directory)
+        chart_files = [n for n in names if os.path.splitext(n)[1].lower() in ['.ssc', '.sm']]
+        audio_files = [n for n in names if os.path.splitext(n)[1].lower() == '.ogg']
+        return chart_files, audio_files
+    entry = chart_util.ListPack(archive).get(member, {'simfiles': [], 'audio': []})
+    return entry['simfiles'], entry['audio']
+
+
+def CheckSimfile(fn):
+    archive, member = chart_util.SplitArchivePath(fn)
+    if archive is None:
+        if not os.path.exists(fn):
+            raise ValueError(f'Simfile or simfile directory does not exist: "{fn}"')
+        is_directory = os.path.isdir(fn)
+    else:
+        is_directory = (member == '') or (member in chart_util.ListPack(archive))
+        if not is_directory and member not in chart_util.OpenArchive(archive).namelist():
+            raise ValueError(f'Simfile or simfile directory does not exist in "{archive}": "{member}"')
+
+    if is_directory:
+        # Accept drag/drop of a directory as well as a .sm or .ssc file
+        song_directory = fn
+        chart_files, audio_files = ListSongDirectory(song_directory)
+        preferred = [n for n in chart_files if os.path.splitext(n)[1].lower() == '.ssc']
+        chart_files = preferred if len(preferred) > 0 else chart_files
+        if len(chart_files) == 0:
+            raise ValueError(f'No .sm or .ssc files found in "{song_directory}"')
+        fn = os.path.join(song_directory, chart_files[0])
+    else:
+        if os.path.splitext(fn)[1].lower() not in ['.ssc', '.sm']:
+            raise ValueError(f'The simfile provided did not have a .sm or .ssc extension: "{fn}"')
+
+    FindAudio(fn)                           # throws if there's no audio to go with it
+    return fn
+
+
+def CheckFunkinEXE(p) -> bool:
+    # Returns whether or not this install has an itch.io directory structure.
+    # Throws errors if it's not a valid install at all.
+    if not os.path.exists(p):
+        raise ValueError(f'Path to Funkin.exe does not exist: "{p}"')
+    if not os.path.exists(os.path.join(p, 'lime.ndll')):
+        raise ValueError(f'Path exists but does not appear to be a complete Friday Night Funkin\' install: "{p}"')
+    if not os.path.exists(os.path.join(p, 'assets', 'data')):
+        raise ValueError(f'Path to Funkin.exe exists but couldn\'t find the chart data subdirectory (/assets/data): "{p}"')
+    if os.path.exists(os.path.join(p, 'assets', 'songs')):
+        return False
+    elif os.path.exists(os.path.join(p, 'assets', 'music')):
+        return True
+    else:
+        raise ValueError(f'Path to Funkin.exe exists but couldn\'t find the song audio subdirectory (/assets/songs or /assets/music): "{p}"')
+
+
+def FindAudio(fn, music=None):
+    # The audio file that goes with a simfile: its #MUSIC (or an .ogg with
+    # the same name, if #MUSIC is e.g. an .mp3), falling back to the first
+    # .ogg next to the simfile.
+    simpath = os.path.dirname(fn)
+    chart_files, audio_files = ListSongDirectory(simpath)
+    if music is None:
+        music = chart_util.ReadMusicTag(fn)
+    if music:
+        stem = os.path.splitext(music.replace('\\', '/'))[0]
+        if chart_util.SplitArchivePath(simpath)[0] is None:
+            candidate = os.path.normpath(os.path.join(simpath, stem + '.ogg'))
+            if os.path.isfile(candidate):
+                return candidate
+        matches = [n for n in audio_files if os.path.splitext(n)[0].lower() == os.path.basename(stem).lower()]
+        if len(matches) > 0:
+            return os.path.join(simpath, matches[0])
+    if len(audio_files) == 0:
+        raise ValueError(f'No .ogg files found in "{simpath}" alongside simfile')
+    return os.path.join(simpath, sorted(audio_files)[0])
+
+
+def LoadCharts(fn):
+    # Every dance-single chart in the simfile, note data left unparsed.
+    return chart_util.LoadChartsSM(fn, chart_type='dance-single', chart_slots=CHART_SLOTS)
+
+
+def DefaultMapping(chart_slots, slots=SLOTS):
+    # Opponent plays the first (hardest) chart everywhere;
+    # the player's chart gets harder with the difficulty slot.
+    chart_slots = list(chart_slots)
+    mapping = {}
+    for i, s in enumerate(slots):
+        i_plr = len(slots) - i - 1
+        i_plr = max(i_plr, 0)
+        i_plr = min(i_plr, len(chart_slots)-1)
+        mapping[s] = (chart_slots[0], chart_slots[i_plr])
+    return mapping
+
+
+def BackupTree(p_sub, p_backup, job=None):
+    # Copy into a scratch directory first, so a cancelled (or crashed)
+    # backup doesn't leave a partial _backup that we'd trust next time.
+    p_partial = p_backup + '.partial'
+    if os.path.isdir(p_partial):
+        shutil.rmtree(p_partial)
+    if job is not None:
+        job.Stage(f'Backing up {os.path.basename(p_sub)}')
+    def copy_checked(src, dst):
+        if job is not None:
+            job.Check()
+        return shutil.copy2(src, dst)
+    shutil.copytree(p_sub, p_partial, copy_function=copy_checked)
+    os.rename(p_partial, p_backup)
+
+
+
+
+def ListSongs(p, itch, job=None):
+    # Songs in the install that have both chart data and audio,
+    # backing up both directories the first time we see them.
+    if not os.path.exists(p):
+        raise ValueError(f'Friday Night Funkin\' path "{p}" not found')
+    if not os.path.exists(os.path.join(p, 'lime.ndll')):
+        raise ValueError(f"{os.path.join(p, 'Funkin.exe')} (FNF executable) not found")
+
+    sl_sub = {}
+    for d_check in ['data', itch and 'music' or 'songs']:
+        p_sub = os.path.join(p, 'assets', d_check)
+        p_backup = os.path.join(p, '_backup', d_check)
+        sl_sub[d_check] = [n for n in os.listdir(p_sub)]
+        if not os.path.isdir(p_backup):
+            BackupTree(p_sub, p_backup, job)
+
+    if itch:
+        return [n for n in sl_sub['data'] if f"{n.title()}_Inst.ogg" in sl_sub['music']]
+    else:
+        return [n for n in sl_sub['data'] if n in sl_sub['songs']]
+
+
+def ParseTimingPairs(field):
+    # "beat=value,beat=value,..." -> sorted [(beat, value), ...]
+    if field is None or len(field.strip()) == 0:
+        return []
+    pairs = [e.strip().split('=') for e in field.split(',') if len(e.strip()) > 0]
+    pairs = [(float(e[0]), float(e[1])) for e in pairs]
+    for b, v in pairs:
+        if not (math.isfinite(b) and math.isfinite(v)):
+            raise chart_util.ChartLimitError(f'Timing event {b}={v} is not a pair of finite numbers')
+    pairs.sort(key=lambda e: e[0])
+    return pairs
+
+
+def MergeIntervals(segments):
+    # (start beat, length in beats) pairs -> sorted, non-overlapping [start, end) intervals
+    merged = []
+    for start, length in sorted(segments):
+        if length <= 0:
+            continue
+        end = start + length
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(m) for m in merged]
+
+
+def GetTimingEffects(gimmick_data, limits=None):
+    limits = chart_util.ResolveLimits(limits)
+    offset = float(gimmick_data['OFFSET'])
+    if not math.isfinite(offset):
+        raise chart_util.ChartLimitError(f'Offset ({offset}) is not a finite number')
+
+    bpms   = ParseTimingPairs(gimmick_data['BPMS'])
+    stops  = ParseTimingPairs(gimmick_data['STOPS'])
+    warps  = ParseTimingPairs(gimmick_data.get('WARPS'))
+    delays = ParseTimingPairs(gimmick_data.get('DELAYS'))
+    fakes  = ParseTimingPairs(gimmick_data.get('FAKES'))
+
+    # A zero BPM would divide by zero below and a beat of 10^7 would make
+    # CompileFNF() allocate 10^7 frames, so stop here instead.
+    if len(bpms) == 0:
+        raise chart_util.ChartLimitError('No BPMs given')
+    for b, v in bpms:
+        chart_util.CheckLimit(limits, 'min_bpm', v, f'BPM at beat {b}')
+    for field in [bpms, stops, warps, delays, fakes]:
+        for b, v in field:
+            chart_util.CheckLimit(limits, 'beat', b, 'Timing event beat')
+
+    bpms.append((1000000.0, bpms[-1][1]))   # Final BPM continues forever
+
+    # Sorted indexes so B2T() is a handful of bisects instead of list scans.
+    bpm_beats = [e[0] for e in bpms]
+    bpm_times = [0.0]
+    for i in range(len(bpms)-1):
+        bpm_times.append(bpm_times[-1] + (bpms[i+1][0] - bpms[i][0]) * 60 / bpms[i][1])
+
+    def prefix(values):
+        sums = [0.0]
+        for v in values:
+            sums.append(sums[-1] + v)
+        return sums
+
+    timing = {
+        'offset': offset,
+        'bpms': bpms,
+        'stops': stops,
+        'warps': warps,
+        'delays': delays,
+        'fakes': fakes,
+        'bpm_beats': bpm_beats,
+        'bpm_times': bpm_times,
+        'stop_beats': [e[0] for e in stops],
+        'stop_prefix': prefix(e[1] for e in stops),
+        'delay_beats': [e[0] for e in delays],
+        'delay_prefix': prefix(e[1] for e in delays),
+    }
+
+    # Warped beats take no time at all; notes in warps or fakes aren't hittable.
+    warp_intervals = MergeIntervals(warps)
+    timing['warp_starts'] = [w[0] for w in warp_intervals]
+    timing['warp_ends'] = [w[1] for w in warp_intervals]
+    timing['warp_prefix'] = prefix(RawTime(timing, w[1]) - RawTime(timing, w[0]) for w in warp_intervals)
+    skip_intervals = MergeIntervals(warps + fakes)
+    timing['skip_starts'] = [s[0] for s in skip_intervals]
+    timing['skip_ends'] = [s[1] for s in skip_intervals]
+
+    return timing
+
+
+def RawTime(timing, b):
+    # Seconds from beat 0 to beat b, counting BPM changes only.
+    i = bisect.bisect_right(timing['bpm_beats'], b) - 1
+    i = max(i, 0)
+    i = min(i, len(timing['bpms'])-2)
+    return timing['bpm_times'][i] + (b - timing['bpm_beats'][i]) * 60 / timing['bpms'][i][1]
+
+
+def B2T(timing, b, verbose=False, manual_offset=0.0):
+    t_bpm = RawTime(timing, b)
+
+    # Stops happen after the notes on their beat, delays before.
+    t_stop = timing['stop_prefix'][bisect.bisect_left(timing['stop_beats'], b)]
+    t_delay = timing['delay_prefix'][bisect.bisect_right(timing['delay_beats'], b)]
+
+    k = bisect.bisect_right(timing['warp_ends'], b)
+    t_warp = timing['warp_prefix'][k]
+    if k < len(timing['warp_starts']) and timing['warp_starts'][k] < b:
+        t_warp += t_bpm - RawTime(timing, timing['warp_starts'][k])
+
+    if verbose:
+        print(f"b{b:3.3f}: bpms {t_bpm:3.3f}, stops {t_stop:3.3f}, delays {t_delay:3.3f}, warped {-t_warp:3.3f}")
+    return -timing['offset'] + manual_offset + t_bpm + t_stop + t_delay - t_warp
+
+
+def TimingSegments(timing):
+    # Every beat where B2T() jumps or changes slope, the time just after it
+    # (so including a stop on that beat), and the seconds per beat until the
+    # next one (zero inside warps). Built on first use and kept in the timing.
+    if 'seg_beats' not in timing:
+        seg_beats = sorted(set(timing['bpm_beats'][:-1] + timing['stop_beats'] + timing['delay_beats'] + timing['warp_starts'] + timing['warp_ends']))
+        seg_times = []
+        seg_rates = []
+        for p in seg_beats:
+            t_stop_here = timing['stop_prefix'][bisect.bisect_right(timing['stop_beats'], p)] - timing['stop_prefix'][bisect.bisect_left(timing['stop_beats'], p)]
+            seg_times.append(B2T(timing, p) + t_stop_here)
+            k = bisect.bisect_right(timing['warp_starts'], p) - 1
+            if k >= 0 and p < timing['warp_ends'][k]:
+                seg_rates.append(0.0)
+            else:
+                i = min(max(bisect.bisect_right(timing['bpm_beats'], p) - 1, 0), len(timing['bpms'])-2)
+                seg_rates.append(60 / timing['bpms'][i][1])
+        timing['seg_beats'] = seg_beats
+        timing['seg_times'] = seg_times
+        timing['seg_rates'] = seg_rates
+    return timing['seg_beats'], timing['seg_times'], timing['seg_rates']
+
+
+def T2B(timing, t, manual_offset=0.0):
+    # Inverse of B2T(): the earliest beat that plays at time t. Times that
+    # fall inside a stop or delay map to the beat it's on; warped-over beats
+    # are never returned, since they take no time.
+    seg_beats, seg_times, seg_rates = TimingSegments(timing)
+    t -= manual_offset
+    i = max(bisect.bisect_right(seg_times, t) - 1, 0)
+    while seg_rates[i] == 0 and i + 1 < len(seg_beats):
+        i += 1
+    b = seg_beats[i] + (t - seg_times[i]) / seg_rates[i]
+    if i + 1 < len(seg_beats):
+        b = min(b, seg_beats[i+1])
+    return b
+
+
+NOTE_KEEP  = 0      # plays exactly where the BPMs and stops alone would put it
+NOTE_SHIFT = 1      # plays, but a warp or delay before it moves it
+NOTE_SKIP  = 2      # inside a warp or fake segment; never hittable
+
+def ClassifyBeats(timing, beats):
+    # One sweep over (sorted) beats against the sorted skip intervals and
+    # the first warp/delay. Unsorted input is sorted by index first.
+    order = range(len(beats))
+    if any(beats[i] > beats[i+1] for i in range(len(beats)-1)):
+        order = sorted(order, key=lambda i: beats[i])
+
+    first_shift = min(timing['warp_starts'][:1] + timing['delay_beats'][:1] + [float('inf')])
+    skip_starts = timing['skip_starts']
+    skip_ends = timing['skip_ends']
+    classes = [NOTE_KEEP] * len(beats)
+    k = 0
+    for i in order:
+        b = beats[i]
+        while k < len(skip_ends) and skip_ends[k] <= b:
+            k += 1
+        if k < len(skip_starts) and skip_starts[k] <= b:
+            classes[i] = NOTE_SKIP
+        elif b >= first_shift:
+            classes[i] = NOTE_SHIFT
+    return classes
+
+
+def DropSkippedNotes(chart_data, timing):
+    # Hold/roll ends are left alone so their heads still pair up correctly.
+    classes = ClassifyBeats(timing, [e['beat'] for e in chart_data])
+    return [e for e, c in zip(chart_data, classes) if c != NOTE_SKIP or e['type'] == 'E']
+
+
+def CalculateTimes(chart_data, gimmick_data, manual_offset=0.0, timing=None):
+    timing = timing or GetTimingEffects(gimmick_data)
+    for e in chart_data:
+        e['time'] = B2T(timing, e['beat'], manual_offset=manual_offset)
+
+
+def CalculateHolds(chart_data):
+    for i, e in enumerate(chart_data):
+        if e['type'] in ['H', 'R']:
+            for potential_end in chart_data[i:]:
+                if potential_end['type'] == 'E' and potential_end['lane'] == e['lane']:
+                    e['blen'] = potential_end['time'] - e['time']
+                    break
+
+
+def BuildSongName(chart_info):
+    name = chart_info['ARTIST']
+    if len(chart_info['ARTISTTRANSLIT'].strip()) != 0:
+        name += f" ({chart_info['ARTISTTRANSLIT']})"
+    name += ' - "'
+    name += chart_info['TITLE']
+    if len(chart_info['TITLETRANSLIT'].strip()) != 0:
+        name += f" ({chart_info['TITLETRANSLIT']})"
+    name += '"'
+    return name
+
+
+def CompileFNF(chart_opp, chart_plr, limits=None):
+    # Everything in here is calculated with no manual offset. A manual
+    # offset moves every note and every frame boundary by the same amount,
+    # so it never changes which frame a note lands in or any frame's BPM.
+    limits = chart_util.ResolveLimits(limits)
+    for c in [chart_opp, chart_plr]:
+        chart_util.ChartNotes(c, limits=limits)
+    chart_opp = deepcopy(chart_opp)
+    chart_plr = deepcopy(chart_plr)
+
+    timing_opp = GetTimingEffects(chart_opp['gimmick'], limits)
+    timing_plr = GetTimingEffects(chart_plr['gimmick'], limits)
+    chart_opp['chart'] = DropSkippedNotes(chart_opp['chart'], timing_opp)
+    chart_plr['chart'] = DropSkippedNotes(chart_plr['chart'], timing_plr)
+
+    beat_max = max(
+        [e['beat'] for e in chart_opp['chart']] +
+        [e['beat'] for e in chart_plr['chart']]
+    )
+    chart_util.CheckLimit(limits, 'beat', beat_max, 'Note beat')      # charts parsed under looser limits
+    frame_notes = [[] for i in range(1 + int(beat_max) // 4)]
+
+    CalculateTimes(chart_opp['chart'], chart_opp['gimmick'], timing=timing_opp)
+    CalculateTimes(chart_plr['chart'], chart_plr['gimmick'], timing=timing_plr)
+    CalculateHolds(chart_opp['chart'])
+    CalculateHolds(chart_plr['chart'])
+
+    # bf in lanes 4-7
+    for e in chart_opp['chart']:
+        e['lane'] += 4
+
+    full_chart = chart_opp['chart'] + chart_plr['chart']
+    full_chart.sort(key=lambda e: e['beat'])
+
+    first_note = None
+    for e in full_chart:
+        if e['type'] in ['E', 'M']:
+            continue
+
+        f = int(e['beat'] / 4)
+        t     = e['time'] * 1000            # milliseconds
+        t_len = e.get('blen', 0) * 1000     # milliseconds
+
+        if e['type'] == 'T':
+            frame_notes[f].append([t, e['lane'], 0])
+        elif e['type'] in ['H', 'R']:
+            frame_notes[f].append([t, e['lane'], t_len])
+        else:
+            continue
+        if first_note is None or t < first_note:
+            first_note = t
+
+    # Frame boundaries and BPMs
+    frames = []
+    errors = []
+    for fi, fn in enumerate(frame_notes):
+        t_start = B2T(timing_plr, fi*4)
+        t_end = B2T(timing_plr, 4+fi*4)
+        bpm = None
+        if (t_end - t_start) < 0.001 and len(fn) > 0:
+            errors.append(f'Frame {fi} has {len(fn)} notes but spans {t_end-t_start:3.3f} seconds?')
+        elif (t_end - t_start) < 0.001:
+            bpm = int(240 / 0.001)                      # empty frame warped over entirely
+        else:
+            bpm = int(240 / (t_end - t_start) + 1e-6)     # don't let float noise truncate 150 to 149
+        frames.append({'bpm': bpm, 'notes': fn})
+
+    return {
+        'frames': frames,
+        'errors': errors,
+        'offset': timing_plr['offset'],
+        'first_note': first_note,               # milliseconds
+        'display_bpm': int(timing_plr['bpms'][0][1])
+    }
+
+
+def FirstMeasureFNF(compiled, manual_offset=0.0):
+    # Let's use the DDR first-measure trick.
+    # Returns the BPM of a teeny measure to insert before the first frame,
+    # or the BPM the first frame should be shrunk to (and None for the other).
+    full_offset = -compiled['offset'] + manual_offset
+    if full_offset > 0.001:                 # Add teeny initial measure
+        return -15 / full_offset, None
+    elif full_offset < 0.001:               # Shrink initial measure slightly
+        spm = 240 / compiled['frames'][0]['bpm']
+        spm -= full_offset
+        return None, 240 / spm
+    return None, None
+
+
+def SummarizeFNF(compiled, manual_offset=0.0):
+    # O(frames) overview of what EmitFNF() would produce with this offset.
+    bpms = [f['bpm'] for f in compiled['frames'] if f['bpm'] is not None]
+    sections = len(compiled['frames'])
+    if len(compiled['errors']) == 0:
+        insert_bpm, first_bpm = FirstMeasureFNF(compiled, manual_offset)
+        if insert_bpm is not None:
+            bpms.append(insert_bpm)
+            sections += 1
+        if first_bpm is not None:
+            bpms[0] = first_bpm
+    first_note = compiled['first_note']
+    return {
+        'sections': sections,
+        'first_note': None if first_note is None else (first_note / 1000 + manual_offset),   # seconds
+        'bpm_min': min(bpms) if len(bpms) > 0 else None,
+        'bpm_max': max(bpms) if len(bpms) > 0 else None,
+        'errors': compiled['errors']
+    }
+
+
+def FramesFNF(compiled, manual_offset=0.0):
+    # Engine-neutral sections with the manual offset applied and the
+    # first-measure trick done: {'steps', 'bpm', 'notes'}, where each note
+    # is [milliseconds, lane, hold milliseconds]. Every emitter wraps these.
+    if len(compiled['errors']) > 0:
+        raise ValueError(compiled['errors'][0])
+
+    t_shift = manual_offset * 1000          # milliseconds
+    frames = [{'steps': 16, 'bpm': f['bpm'], 'notes': [[n[0] + t_shift, n[1], n[2]] for n in f['notes']]} for f in compiled['frames']]
+
+    insert_bpm, first_bpm = FirstMeasureFNF(compiled, manual_offset)
+    if insert_bpm is not None:
+        frames.insert(0, {'steps': 1, 'bpm': insert_bpm, 'notes': []})
+    elif first_bpm is not None:
+        frames[0]['bpm'] = first_bpm
+    return frames
+
+
+def EmitKade(frames, compiled, speed, song_name):
+    notes = []
+    for f in frames:
+        notes.append({
+            'lengthInSteps': f['steps'],
+            'bpm': f['bpm'],
+            'changeBPM': False,
+            'mustHitSection': True,
+            'sectionNotes': f['notes'],
+            'typeOfSection': 0
+        })
+
+    # Create full song JSON!
+    display_bpm = compiled['display_bpm']
+    return {
+        'song': {
+            'song': song_name,              # injecting rather than adding a new song oops
+            'notes': notes,
+            'bpm': display_bpm,
+            'sections': 0,
+            'needsVoices': False,
+            'player1': 'bf',
+            'player2': 'dad',               # TODO: Match character?
+            'sectionLengths': [],
+            'speed': speed,
+            'validScore': True
+        },
+        'bpm': display_bpm,
+        'sections': len(notes)
+    }
+
+
+def EmitPsych(frames, compiled, speed, song_name):
+    # Psych Engine reads sectionBeats (0.7+) or lengthInSteps (earlier),
+    # so both are written.
+    notes = []
+    for f in frames:
+        notes.append({
+            'sectionNotes': f['notes'],
+            'sectionBeats': f['steps'] / 4,
+            'lengthInSteps': f['steps'],
+            'typeOfSection': 0,
+            'mustHitSection': True,
+            'gfSection': False,
+            'bpm': f['bpm'],
+            'changeBPM': False,
+            'altAnim': False
+        })
+    return {
+        'song': {
+            'song': song_name,
+            'notes': notes,
+            'events': [],
+            'bpm': compiled['display_bpm'],
+            'needsVoices': False,
+            'player1': 'bf',
+            'player2': 'dad',
+            'gfVersion': 'gf',
+            'stage': 'stage',
+            'speed': speed,
+            'validScore': True,
+            'arrowSkin': '',
+            'splashSkin': ''
+        }
+    }
+
+
+def EmitVanilla(frames, compiled, speed, song_name):
+    notes = []
+    for f in frames:
+        notes.append({
+            'lengthInSteps': f['steps'],
+            'bpm': f['bpm'],
+            'changeBPM': False,
+            'mustHitSection': True,
+            'sectionNotes': f['notes'],
+            'typeOfSection': 0
+        })
+    return {
+        'song': {
+            'song': song_name,
+            'notes': notes,
+            'bpm': compiled['display_bpm'],
+            'needsVoices': False,
+            'player1': 'bf',
+            'player2': 'dad',
+            'speed': speed,
+            'validScore': True
+        }
+    }
+
+
+# Song JSON layout per engine: emitter(frames, compiled, speed, song name).
+EMITTERS = {
+    'kade': EmitKade,
+    'psych': EmitPsych,
+    'vanilla': EmitVanilla
+}
+DEFAULT_ENGINE = 'kade'
+
+
+def EmitEngines(compiled, engines, manual_offset=0.0, speed=2.0, song_name=''):
+    # One FramesFNF() shared by every requested engine's song JSON.
+    for engine in engines:
+        if engine not in EMITTERS:
+            raise ValueError(f'Unknown engine "{engine}" (expected one of {", ".join(EMITTERS)})')
+    frames = FramesFNF(compiled, manual_offset)
+    return {engine: EMITTERS[engine](frames, compiled, speed, song_name) for engine in engines}
+
+
+def EmitFNF(compiled, manual_offset=0.0, speed=2.0, song_name='', engine=DEFAULT_ENGINE):
+    return EmitEngines(compiled, [engine], manual_offset, speed, song_name)[engine]
+
+
+def ManualOffsetFNF(song_dict, timing_plr):
+    # Undo FirstMeasureFNF(): the manual offset a song JSON was emitted
+    # with, given the timing of the player chart it was compiled from.
+    sections = song_dict['song']['notes']
+    if len(sections) == 0:
+        return 0.0
+    if sections[0]['lengthInSteps'] != 16:             # teeny inserted measure
+        full_offset = -15 / sections[0]['bpm']
+    else:
+        span = B2T(timing_plr, 4) - B2T(timing_plr, 0)
+        bpm = int(240 / 0.001) if span < 0.001 else int(240 / span + 1e-6)
+        full_offset = 240 / bpm - 240 / sections[0]['bpm']
+    return full_offset + timing_plr['offset']
+
+
+BEAT_GRID = 48          # rows per beat in a 192nd-note measure
+
+def ReadFNF(song_dict, timing_opp, timing_plr=None, manual_offset=0.0):
+    # Read an FNF song JSON back into chart_util-style notes. Note times are
+    # mapped to beats through each side's timing and snapped to 192nds.
+    # Returns (opponent notes, player notes), each sorted by beat and lane,
+    # as {'beat', 'lane', 'type', 'time', 'drift'} with holds split into an
+    # 'H' head and an 'E' end, and 'drift' the seconds between the note's
+    # time and its snapped beat's.
+    timing_plr = timing_plr or timing_opp
+    charts = ([], [])
+    for section in song_dict['song']['notes']:
+        for t_ms, lane, len_ms in section['sectionNotes']:
+            is_opp = lane >= 4
+            timing = timing_opp if is_opp else timing_plr
+            events = [('H' if len_ms > 0 else 'T', t_ms)]
+            if len_ms > 0:
+                events.append(('E', t_ms + len_ms))
+            for note_type, t_event in events:
+                t_event /= 1000
+                beat = round(T2B(timing, t_event, manual_offset) * BEAT_GRID) / BEAT_GRID
+                charts[0 if is_opp else 1].append({
+                    'beat': beat,
+                    'lane': lane % 4,
+                    'type': note_type,
+                    'time': t_event,
+                    'drift': t_event - B2T(timing, beat, manual_offset=manual_offset)
+                })
+    for c in charts:
+        c.sort(key=lambda e: (e['beat'], e['lane'], e['type']))
+    return charts
+
+
+def QueueCopy(output, src, dest, sources=None):
+    # Files inside a .zip pack are streamed member-to-destination in chunks,
+    # unless they've already been read into sources (see SharedSources()).
+    if sources is not None and src in sources:
+        output.Copy(src, dest, opener=sources[src])
+    elif chart_util.SplitArchivePath(src)[0] is None:
+        output.Copy(src, dest)
+    else:
+        output.Copy(src, dest, opener=lambda: chart_util.OpenBinary(src))
+
+
+def SharedSources(paths):
+    # Read archive members once for several installs to copy from;
+    # plain files are left to the OS cache.
+    sources = {}
+    for p in paths:
+        if p not in sources and chart_util.SplitArchivePath(p)[0] is not None:
+            with chart_util.OpenBinary(p) as fp:
+                contents = fp.read()
+            sources[p] = lambda contents=contents: io.BytesIO(contents)
+    return sources
+
+
+def SongLayout(path, itch, song, simfile, slots=SLOTS):
+    # Where each file of an injected song goes in this install.
+    layout = {
+        'json': {s: os.path.join(path, 'assets/data', song, song + slots[s] + '.json') for s in slots},
+        'source': os.path.join(path, 'assets/data', song, song + '-source' + os.path.splitext(simfile)[1].lower())
+    }
+    if itch:
+        layout['inst'] = os.path.join(path, 'assets/music', f'{song.title()}_Inst.ogg')
+        layout['voices'] = os.path.join(path, 'assets/music', f'{song.title()}_Voices.ogg')
+    else:
+        layout['inst'] = os.path.join(path, 'assets/songs', song, 'Inst.ogg')
+        layout['voices'] = os.path.join(path, 'assets/songs', song, 'Voices.ogg')
+    return layout
+
+
+def WriteSong(path, itch, song, simfile, song_dicts, silence, slots=SLOTS, output=None, fn_audio=None, sources=None):
+    # Inject the converted difficulties, the source simfile, and the
+    # audio (with a silent voices track) into an FNF install.
+    # Pass an OutputStage to batch several songs together and Commit() it
+    # yourself; otherwise the files are committed here and the per-file
+    # report is returned.
+    own_output = output is None
+    if own_output:
+        import output_util                      # thread pool machinery; only needed to write
+        output = output_util.OutputStage()
+
+    try:
+        fn_audio = fn_audio or FindAudio(simfile)
+        layout = SongLayout(path, itch, song, simfile, slots)
+        for s in slots:
+            output.WriteJSON(layout['json'][s], song_dicts[s])
+        QueueCopy(output, simfile, layout['source'], sources)
+        QueueCopy(output, fn_audio, layout['inst'], sources)
+        QueueCopy(output, silence, layout['voices'], sources)
+        if own_output:
+            return output.Commit()
+    finally:
+        if own_output:
+            output.Close()
+
+
+def Targets(data, engine=None):
+    # Every install a conversion goes to: the main "path", then the
+    # "targets" from the defaults JSON, each either a path or
+    # {"path": ..., "engine": ...}. engine overrides them all.
+    # Nothing is checked on disk here; WriteTargets() does that per install.
+    targets = []
+    seen = set()
+    for t in ([data['path']] if 'path' in data else []) + data.get('targets', []):
+        if isinstance(t, str):
+            t = {'path': t}
+        key = os.path.normcase(os.path.abspath(t['path']))
+        if key in seen:
+            continue
+        seen.add(key)
+        targets.append({
+            'path': t['path'],
+            'engine': engine or t.get('engine', data.get('engine', DEFAULT_ENGINE))
+        })
+    return targets
+
+
+def WriteTargets(targets, song, simfile, song_dicts, silence, slots=SLOTS, job=None, list_songs=ListSongs):
+    # WriteSong() into every target install at once, each with its own
+    # OutputStage so the installs are written in parallel and one bad
+    # install can't hold up the rest. song_dicts is engine -> slot -> JSON.
+    # list_songs(path, itch, job) can be swapped for a cached song list.
+    # Returns ({install path: per-file report}, [error, ...]).
+    import output_util
+
+    fn_audio = FindAudio(simfile)
+    sources = SharedSources([simfile, fn_audio, silence]) if len(targets) > 1 else None
+    reports = {}
+    errors = []
+    stages = {}
+    try:
+        for t in targets:
+            try:
+                itch = CheckFunkinEXE(t['path'])
+                if song not in list_songs(t['path'], itch, job):    # also backs it up the first time
+                    raise ValueError(f'no song "{song}" to replace')
+                output = output_util.OutputStage()
+                try:
+                    WriteSong(t['path'], itch, song, simfile, song_dicts[t['engine']], silence, slots, output, fn_audio, sources)
+                except:
+                    output.Close()          # never commit a half-queued install
+                    raise
+                stages[t['path']] = output
+            except Exception as e:
+                if job is not None:
+                    job.Check()         # cancelled (e.g. mid-backup): raise that, and commit nothing
+                errors.append(f"{t['path']}: {e}")
+        if job is not None:
+            job.Check()
+        for p, output in stages.items():
+            try:
+                reports[p] = output.Commit()
+            except Exception as e:
+                errors.append(f'{p}: {e}')
+    finally:
+        for output in stages.values():
+            output.Close()
+    return reports, errors
+
+
+_import_ms = (time.perf_counter() - _t_import_start) * 1000
+
+
+if __name__ == '__main__':
+    import argparse
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Inject a StepMania simfile into Friday Night Funkin' without the GUI.")
+    parser.add_argument('simfile', help='.sm/.ssc file or song directory')
+    parser.add_argument('song', help='FNF song to replace (e.g. bopeebo)')
+    parser.add_argument('--path', help='directory containing Funkin.exe (default: the "path" and any "targets" in the defaults JSON)')
+    parser.add_argument('--defaults', default=os.path.join(root, 'assets', 'SaturdayMorning_defaults.json'))
+    parser.add_argument('--offset', type=float, default=0.0, help='additional offset (sec)')
+    parser.add_argument('--speed', type=float, default=None, help='speed modifier')
+    parser.add_argument('--engine', choices=list(EMITTERS), default=None, help=f'song JSON layout (default: from the defaults JSON, or {DEFAULT_ENGINE})')
+    parser.add_argument('--dry-run', action='store_true', help="convert, but don't write anything")
+    parser.add_argument('--timings', action='store_true', help='print import and per-stage timings')
+    args = parser.parse_args()
+
+    data = {}
+    if os.path.exists(args.defaults):
+        with open(args.defaults, 'r') as fp:
+            data = json.load(fp)
+    if args.path is not None:
+        data = dict(data, path=args.path, targets=[])
+    if data.get('path') is None:
+        raise ValueError("Must provide a path to a Friday Night Funkin' install (--path) to proceed.")
+    speed = args.speed or data.get('speed', 2.0)
+    chart_util.SetChartLimits(data.get('limits'))
+    targets = Targets(data, args.engine)
+    engines = sorted(set(t['engine'] for t in targets))
+    silence = os.path.join(root, data.get('silence', r'assets/silence.ogg'))
+
+    timings = [('import', _import_ms)]
+    def lap(label, t0):
+        timings.append((label, (time.perf_counter() - t0) * 1000))
+        return time.perf_counter()
+
+    t = time.perf_counter()
+    fn = CheckSimfile(args.simfile)
+    charts = LoadCharts(fn)
+    if len(charts) == 0:
+        raise ValueError(f'No dance-single charts found in "{fn}"')
+    import analytics_util
+    import ogg_util
+    mapping = analytics_util.AutoMapping(analytics_util.AnalyzeCharts(charts))
+    for problem in ogg_util.FitProblems(ogg_util.AudioFit(fn, charts), args.offset):
+        print(f'!!! {problem}')
+    t = lap('load', t)
+
+    compiled = {}
+    song_dicts = {e: {} for e in engines}
+    for s in SLOTS:
+        if mapping[s] not in compiled:
+            compiled[mapping[s]] = CompileFNF(charts[mapping[s][0]], charts[mapping[s][1]])
+        emitted = EmitEngines(compiled[mapping[s]], engines, args.offset, speed, args.song.title())
+        for e in engines:
+            song_dicts[e][s] = emitted[e]
+        print(f'{s}: opponent {mapping[s][0]}, player {mapping[s][1]}, {len(emitted[engines[0]]["song"]["notes"])} sections')
+    t = lap('convert', t)
+
+    reports = {}
+    errors = []
+    if not args.dry_run:
+        reports, errors = WriteTargets(targets, args.song, fn, song_dicts, silence)
+        t = lap('write', t)
+        for p in reports:
+            print(f'Injected into {p}')
+        for e in errors:
+            print(f'!!! {e}')
+
+    if args.timings:
+        print(', '.join(f'{label} {ms:.1f} ms' for label, ms in timings))
+        for report in reports.values():
+            for r in report:
+                print(f"    {r['path']}: write {r['write_ms']:.1f} ms, fsync {r['sync_ms']:.1f} ms")
+        if _import_ms > IMPORT_BUDGET_MS:
+            print(f'!!! Import took {_import_ms:.1f} ms, over the {IMPORT_BUDGET_MS} ms budget')
+    if len(errors) > 0:
+        sys.exit(1)
@@ -0,0 +1,158 @@
+# ogg_util.py: Ogg audio length from page headers, and checking charts fit their audio
+# Copyright (C) 2021 Telperion (github.com/telperion)
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+
+# No audio is decoded here. An Ogg stream is a run of pages, each with a
+# 27-byte header holding the granule position (for Vorbis, the sample count
+# at the end of the page). The sample rate comes from the identification
+# header in the first page, and the length from the granule position of
+# the last page, which is always within the last 64 KiB of the file.
+
+
+import os
+import sys
+import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import chart_util
+import fnf_util
+
+OGG_PAGE = struct.Struct('<4sBBqIIIB')      # capture, version, flags, granule, serial, sequence, CRC, segments
+OGG_MAX_PAGE = OGG_PAGE.size + 255 + 255 * 255
+
+
+
+def ReadFirstPacket(fp):
+    # (serial number, first packet) of the first page.
+    header = fp.read(OGG_PAGE.size)
+    if len(header) < OGG_PAGE.size:
+        raise ValueError('File is too short to be an Ogg stream')
+    capture, version, flags, granule, serial, sequence, crc, n_segments = OGG_PAGE.unpack(header)
+    if capture != b'OggS' or version != 0:
+        raise ValueError('Not an Ogg stream')
+    lacing = fp.read(n_segments)
+    return serial, fp.read(sum(lacing))
+
+
+def LastGranule(tail, serial):
+    # Granule position of the last complete page of this stream in tail.
+    # Pages where no packet finishes have a granule position of -1.
+    i = len(tail)
+    while True:
+        i = tail.rfind(b'OggS', 0, i)
+        if i < 0:
+            raise ValueError('No Ogg page found near the end of the file')
+        if i + OGG_PAGE.size <= len(tail):
+            capture, version, flags, granule, page_serial, sequence, crc, n_segments = OGG_PAGE.unpack_from(tail, i)
+            if version == 0 and page_serial == serial and granule >= 0:
+                return granule
+
+
+def OggInfo(path):
+    # {'codec', 'channels', 'sample_rate', 'samples', 'duration' (seconds)}
+    # for an Ogg Vorbis or Opus file, which may be inside a .zip pack.
+    with chart_util.OpenBinary(path) as fp:
+        serial, packet = ReadFirstPacket(fp)
+        if packet[:7] == b'\x01vorbis':
+            codec = 'vorbis'
+            channels, sample_rate = struct.unpack_from('<BI', packet, 11)
+            pre_skip = 0
+        elif packet[:8] == b'OpusHead':
+            codec = 'opus'
+            channels, pre_skip = struct.unpack_from('<BH', packet, 9)
+            sample_rate = 48000                 # Opus granules always count 48 kHz samples
+        else:
+            raise ValueError(f'"{path}" is Ogg, but neither Vorbis nor Opus')
+
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(max(size - OGG_MAX_PAGE, 0))
+        samples = LastGranule(fp.read(), serial) - pre_skip
+
+    return {
+        'codec': codec,
+        'channels': channels,
+        'sample_rate': sample_rate,
+        'samples': samples,
+        'duration': samples / sample_rate
+    }
+
+
+def LastNoteTime(chart_entry):
+    # Seconds from the start of the audio to the chart's last step or hold
+    # end, or None if there isn't one. Only the tail of the note data is read.
+    beat = chart_util.LastNoteBeat(chart_entry['notes'])
+    if beat is None:
+        return None
+    last_note = [{'beat': beat}]
+    fnf_util.CalculateTimes(last_note, chart_entry['gimmick'])
+    return last_note[0]['time']
+
+
+def AudioFit(fn, charts=None):
+    # The audio a simfile resolves to, its length, and when each chart ends.
+    charts = charts if charts is not None else fnf_util.LoadCharts(fn)
+    fn_audio = fnf_util.FindAudio(fn)
+    return {
+        'simfile': fn,
+        'audio': fn_audio,
+        'duration': OggInfo(fn_audio)['duration'],
+        'last_note': {c: LastNoteTime(charts[c]) for c in charts}
+    }
+
+
+def FitProblems(fit, manual_offset=0.0):
+    problems = []
+    for c, t in fit['last_note'].items():
+        if t is not None and t + manual_offset > fit['duration']:
+            problems.append(f"{c} chart ends at {t + manual_offset:.2f} s, after {os.path.basename(fit['audio'])} does ({fit['duration']:.2f} s)")
+    return problems
+
+
+def ValidatePack(pack_path, max_workers=8):
+    # AudioFit() for every song in a pack directory or .zip pack. Songs that
+    # can't be checked at all come back with an 'error' instead.
+    def check(fn):
+        try:
+            fit = AudioFit(fn)
+            fit['problems'] = FitProblems(fit)
+            return fit
+        except Exception as e:
+            return {'simfile': fn, 'error': str(e)}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(check, chart_util.PackSimfiles(pack_path)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check that every chart in a pack ends before its audio does.")
+    parser.add_argument('pack', help='pack directory or .zip pack (or a single song directory)')
+    args = parser.parse_args()
+
+    results = ValidatePack(args.pack)
+    failed = 0
+    for r in results:
+        if 'error' in r:
+            failed += 1
+            print(f"!!! {r['simfile']}: {r['error']}")
+        elif len(r['problems']) > 0:
+            failed += 1
+            for p in r['problems']:
+                print(f"!!! {r['simfile']}: {p}")
+    print(f'{len(results) - failed} of {len(results)} songs fit their audio')
+    sys.exit(1 if failed > 0 else 0)
@@ -0,0 +1,146 @@
+# output_util.py: Concurrent, atomic file output for song injection
+# Copyright (C) 2021 Telperion (github.com/telperion)
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import os
+import json
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+COPY_CHUNK = 1 << 20
+
+
+
+class OutputStage:
+    """
+    Collects every file a song injection (or a batch of them) writes.
+    Writes and copies run on a bounded thread pool, each into a temp file
+    beside its destination. Commit() then fsyncs them all in one batch and
+    renames them into place, so the game never sees a half-written file.
+    """
+
+    def __init__(self, max_workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []           # (destination, future -> (temp path, bytes, write ms))
+        self.report = []
+
+    def _Temp(self, dest):
+        fd, tmp = tempfile.mkstemp(prefix=f'.{os.path.basename(dest)}.', suffix='.tmp', dir=os.path.dirname(dest) or '.')
+        return fd, tmp
+
+    def _WriteJSON(self, dest, obj):
+        t0 = time.perf_counter()
+        fd, tmp = self._Temp(dest)
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(obj, fp)
+            if os.path.exists(dest):
+                shutil.copymode(dest, tmp)
+            else:
+                os.chmod(tmp, 0o644)            # mkstemp files start out private
+        except:
+            os.remove(tmp)
+            raise
+        return tmp, os.path.getsize(tmp), (time.perf_counter() - t0) * 1000
+
+    def _Copy(self, src, dest, opener):
+        t0 = time.perf_counter()
+        fd, tmp = self._Temp(dest)
+        try:
+            with os.fdopen(fd, 'wb') as fp_out:
+                with (opener() if opener is not None else open(src, 'rb')) as fp_in:
+                    shutil.copyfileobj(fp_in, fp_out, COPY_CHUNK)
+            if opener is None:
+                shutil.copystat(src, tmp)
+            else:
+                os.chmod(tmp, 0o644)
+        except:
+            os.remove(tmp)
+            raise
+        return tmp, os.path.getsize(tmp), (time.perf_counter() - t0) * 1000
+
+    def WriteJSON(self, dest, obj):
+        self.pending.append((dest, self.pool.submit(self._WriteJSON, dest, obj)))
+
+    def Copy(self, src, dest, opener=None):
+        # opener, if given, returns the binary file to read instead of
+        # opening src (e.g. a member of a .zip pack).
+        self.pending.append((dest, self.pool.submit(self._Copy, src, dest, opener)))
+
+    @staticmethod
+    def _Sync(tmp):
+        t0 = time.perf_counter()
+        fd = os.open(tmp, os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return (time.perf_counter() - t0) * 1000
+
+    def Commit(self):
+        # Wait for every queued write, fsync them together, then move them
+        # into place. If anything failed, nothing is moved.
+        pending, self.pending = self.pending, []
+        written = []
+        errors = []
+        for dest, future in pending:
+            try:
+                written.append((dest,) + future.result())
+            except Exception as e:
+                errors.append(e)
+        if len(errors) > 0:
+            for dest, tmp, size, write_ms in written:
+                os.remove(tmp)
+            raise errors[0]
+
+        sync_ms = list(self.pool.map(OutputStage._Sync, [w[1] for w in written]))
+        dirs = set()
+        for (dest, tmp, size, write_ms), s_ms in zip(written, sync_ms):
+            os.replace(tmp, dest)
+            dirs.add(os.path.dirname(dest) or '.')
+            self.report.append({'path': dest, 'bytes': size, 'write_ms': write_ms, 'sync_ms': s_ms})
+        if os.name == 'posix':
+            for d in dirs:              # make the renames themselves durable
+                fd = os.open(d, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        return self.report
+
+    def Abort(self):
+        pending, self.pending = self.pending, []
+        for dest, future in pending:
+            try:
+                os.remove(future.result()[0])
+            except Exception:
+                pass
+
+    def Close(self):
+        self.Abort()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+    def Summary(self):
+        return [f"{os.path.basename(r['path'])}: {r['bytes'] / 1024:.0f} KiB, write {r['write_ms']:.1f} ms, fsync {r['sync_ms']:.1f} ms" for r in self.report]
@@ -0,0 +1,195 @@
+# verify_util.py: Check that songs injected into Friday Night Funkin' still match their simfiles
+# Copyright (C) 2021 Telperion (github.com/telperion)
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+
+# Every injected song keeps its simfile as assets/data/<song>/<song>-source.*,
+# so each difficulty JSON can be read back (fnf_util.ReadFNF) and diffed
+# against the chart it most likely came from. Two kinds of drift come out:
+#
+#   note drift:     how far a note's time is from its snapped beat's time;
+#                   anything over a fraction of a millisecond is a bug.
+#   section drift:  how far FNF's section boundaries (built from the
+#                   integer section BPMs) wander from the simfile's measures.
+
+
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import chart_util
+import fnf_util
+
+
+
+def SourceNotes(chart_entry, timing, limits=None):
+    # The simfile chart as FNF should have it: no mines, no skipped notes,
+    # rolls as holds, and hold ends only where a head found one.
+    notes = fnf_util.DropSkippedNotes(chart_util.ChartNotes(chart_entry, limits=limits), timing)
+    source = []
+    for i, e in enumerate(notes):
+        beat = round(e['beat'] * fnf_util.BEAT_GRID) / fnf_util.BEAT_GRID
+        if e['type'] == 'T':
+            source.append({'beat': beat, 'lane': e['lane'], 'type': 'T'})
+        elif e['type'] in ['H', 'R']:
+            source.append({'beat': beat, 'lane': e['lane'], 'type': 'H'})
+            for potential_end in notes[i:]:
+                if potential_end['type'] == 'E' and potential_end['lane'] == e['lane']:
+                    source.append({'beat': round(potential_end['beat'] * fnf_util.BEAT_GRID) / fnf_util.BEAT_GRID, 'lane': e['lane'], 'type': 'E'})
+                    break
+    source.sort(key=lambda e: (e['beat'], e['lane'], e['type']))
+    return source
+
+
+def SectionDrift(song_dict, timing_plr, manual_offset):
+    # Largest gap (seconds) between where FNF thinks each section starts and
+    # where the simfile's measure actually starts.
+    t = 0.0
+    drift = 0.0
+    fi = 0
+    for i, section in enumerate(song_dict['song']['notes']):
+        if i == 0 and section['lengthInSteps'] != 16:      # teeny inserted measure
+            t += section['lengthInSteps'] * 15 / abs(section['bpm'])
+            continue
+        drift = max(drift, abs(t - fnf_util.B2T(timing_plr, fi*4, manual_offset=manual_offset)))
+        t += section['lengthInSteps'] * 15 / abs(section['bpm'])
+        fi += 1
+    return drift
+
+
+def Mismatches(source, notes):
+    a_diff, b_diff = chart_util.DiffCharts(source, notes)
+    return len(a_diff) + len(b_diff)
+
+
+def FindSource(path, song):
+    for ext in ['.ssc', '.sm']:
+        fn = os.path.join(path, 'assets/data', song, song + '-source' + ext)
+        if os.path.exists(fn):
+            return fn
+    return None
+
+
+def VerifySong(path, song, slots=fnf_util.SLOTS, limits=None):
+    # limits is passed along explicitly since worker processes don't
+    # necessarily share the parent's chart_util.ChartLimits.
+    fn = FindSource(path, song)
+    if fn is None:
+        raise ValueError(f'No source simfile stored for "{song}"')
+    charts = fnf_util.LoadCharts(fn)
+    if len(charts) == 0:
+        raise ValueError(f'No dance-single charts in "{fn}"')
+    timings = {c: fnf_util.GetTimingEffects(charts[c]['gimmick'], limits) for c in charts}
+    sources = {c: SourceNotes(charts[c], timings[c], limits) for c in charts}
+
+    result = {'song': song, 'slots': {}, 'mismatches': 0, 'note_drift_ms': 0.0, 'section_drift_ms': 0.0, 'errors': []}
+    for s in slots:
+        fn_json = os.path.join(path, 'assets/data', song, song + slots[s] + '.json')
+        if not os.path.exists(fn_json):
+            result['errors'].append(f'{s}: "{os.path.basename(fn_json)}" is missing')
+            continue
+        with open(fn_json, 'r') as fp:
+            song_dict = json.load(fp)
+
+        # The player chart decides the manual offset and the section BPMs,
+        # so try each one in turn; the opponent is matched afterwards.
+        best = None
+        for c in charts:
+            manual_offset = fnf_util.ManualOffsetFNF(song_dict, timings[c])
+            notes_plr = fnf_util.ReadFNF(song_dict, timings[c], manual_offset=manual_offset)[1]
+            mismatches_plr = Mismatches(sources[c], notes_plr)
+            if best is None or mismatches_plr < best[1]:
+                best = (c, mismatches_plr, manual_offset, notes_plr)
+        chart_plr, mismatches_plr, manual_offset, notes_plr = best
+
+        best = None
+        for c in charts:
+            notes_opp = fnf_util.ReadFNF(song_dict, timings[c], timings[chart_plr], manual_offset=manual_offset)[0]
+            mismatches_opp = Mismatches(sources[c], notes_opp)
+            if best is None or mismatches_opp < best[1]:
+                best = (c, mismatches_opp, notes_opp)
+        chart_opp, mismatches_opp, notes_opp = best
+
+        note_drift = max([abs(e['drift']) for e in notes_opp + notes_plr] + [0.0])
+        section_drift = SectionDrift(song_dict, timings[chart_plr], manual_offset)
+        result['slots'][s] = {
+            'opponent': chart_opp,
+            'player': chart_plr,
+            'manual_offset': manual_offset,
+            'mismatches': mismatches_opp + mismatches_plr,
+            'note_drift_ms': note_drift * 1000,
+            'section_drift_ms': section_drift * 1000
+        }
+        result['mismatches'] += mismatches_opp + mismatches_plr
+        result['note_drift_ms'] = max(result['note_drift_ms'], note_drift * 1000)
+        result['section_drift_ms'] = max(result['section_drift_ms'], section_drift * 1000)
+    return result
+
+
+def InjectedSongs(path):
+    # Every song in an install that has a source simfile to check against.
+    p_data = os.path.join(path, 'assets/data')
+    return sorted(d for d in os.listdir(p_data) if FindSource(path, d) is not None)
+
+
+def VerifyInstall(path, songs=None, slots=fnf_util.SLOTS, max_workers=None, limits=None):
+    # VerifySong() for every injected song, one process per core. Songs
+    # that can't be checked at all come back with only 'errors' filled in.
+    songs = songs if songs is not None else InjectedSongs(path)
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [(song, pool.submit(VerifySong, path, song, slots, limits)) for song in songs]
+        for song, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'song': song, 'slots': {}, 'mismatches': 0, 'note_drift_ms': 0.0, 'section_drift_ms': 0.0, 'errors': [str(e)]})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check songs injected into Friday Night Funkin' against their source simfiles.")
+    parser.add_argument('songs', nargs='*', help='songs to check (default: every song with a stored source simfile)')
+    parser.add_argument('--path', help='directory containing Funkin.exe (default: from the defaults JSON)')
+    parser.add_argument('--defaults', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'SaturdayMorning_defaults.json'))
+    parser.add_argument('--workers', type=int, default=None, help='processes to use (default: one per core)')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='note drift (ms) above which a song fails')
+    parser.add_argument('--section-tolerance', type=float, default=50.0, help='section drift (ms) above which a song fails')
+    args = parser.parse_args()
+
+    data = {}
+    if os.path.exists(args.defaults):
+        with open(args.defaults, 'r') as fp:
+            data = json.load(fp)
+    path = args.path or data.get('path')
+    if path is None:
+        raise ValueError("Must provide a path to a Friday Night Funkin' install (--path) to proceed.")
+
+    results = VerifyInstall(path, args.songs or None, max_workers=args.workers, limits=data.get('limits'))
+    failed = 0
+    for r in sorted(results, key=lambda r: -r['note_drift_ms']):
+        ok = len(r['errors']) == 0 and r['mismatches'] == 0 and r['note_drift_ms'] <= args.tolerance and r['section_drift_ms'] <= args.section_tolerance
+        failed += not ok
+        print(f"{'ok ' if ok else '!!!'} {r['song']}: {r['mismatches']} mismatched notes, note drift {r['note_drift_ms']:.3f} ms, section drift {r['section_drift_ms']:.1f} ms")
+        for s, v in r['slots'].items():
+            print(f"        {s}: opponent {v['opponent']}, player {v['player']}, offset {v['manual_offset']:+.3f} s, {v['mismatches']} mismatched, drift {v['note_drift_ms']:.3f} / {v['section_drift_ms']:.1f} ms")
+        for e in r['errors']:
+            print(f'        {e}')
+    print(f'{len(results) - failed} of {len(results)} songs match')
+    sys.exit(1 if failed > 0 else 0)
@@ -0,0 +1,263 @@
+# watch_util.py: Re-inject simfiles into Friday Night Funkin' whenever they're saved
+# Copyright (C) 2021 Telperion (github.com/telperion)
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+
+# Watch entries live in SaturdayMorning_defaults.json next to the FNF path:
+#
+#   "watch": [
+#       {
+#           "simfile": "C:/Songs/My Pack/My Song/My Song.ssc",
+#           "song": "bopeebo",
+#           "offset": 0.0,
+#           "speed": 2.0,
+#           "engine": "kade",
+#           "mapping": {"Easy": ["Easy", "Easy"], "Normal": ["Hard", "Medium"], "Hard": ["Challenge", "Hard"]}
+#       }
+#   ]
+#
+# where each mapping is difficulty slot -> [opponent chart, player chart].
+# "engine" is optional and falls back to the "engine" next to the FNF path
+# (see fnf_util.EMITTERS), then to Kade Engine.
+
+
+import os
+import sys
+import json
+import time
+import select
+import struct
+import hashlib
+import argparse
+
+import chart_util
+import fnf_util
+import output_util
+
+
+
+def ChartHash(chart_entry):
+    # Identifies a chart by everything that feeds into its conversion.
+    h = hashlib.sha1()
+    h.update(chart_entry['notes'].encode('utf-8'))
+    h.update(repr(sorted(chart_entry['gimmick'].items())).encode('utf-8'))
+    return h.hexdigest()
+
+
+class PollingWatcher:
+    """
+    Notices changes to a set of files by comparing their modification time
+    and size every so often. Works everywhere.
+    """
+
+    def __init__(self, paths, interval=0.25):
+        self.interval = interval
+        self.stats = {p: self._Stat(p) for p in paths}
+
+    @staticmethod
+    def _Stat(p):
+        try:
+            st = os.stat(p)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def Wait(self, timeout):
+        # Returns the set of watched paths that changed, or an empty set
+        # if nothing changed within the timeout.
+        deadline = time.perf_counter() + timeout
+        while True:
+            changed = set()
+            for p, prev in self.stats.items():
+                cur = self._Stat(p)
+                if cur != prev:
+                    self.stats[p] = cur
+                    if cur is not None:
+                        changed.add(p)
+            if len(changed) > 0:
+                return changed
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+
+    def Close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Notices changes to a set of files through Linux inotify. The parent
+    directories are watched rather than the files themselves, since most
+    editors save by writing a new file and renaming it over the old one.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    _event_header  = struct.Struct('iIII')
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+        self.paths = set(paths)
+        self.dirs = {}
+        for d in set(os.path.dirname(p) for p in self.paths):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                self.Close()
+                raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for "{d}"')
+            self.dirs[wd] = d
+
+    def Wait(self, timeout):
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return changed
+        buf = os.read(self.fd, 65536)
+        i = 0
+        while i + self._event_header.size <= len(buf):
+            wd, mask, cookie, name_len = self._event_header.unpack_from(buf, i)
+            i += self._event_header.size
+            name = os.fsdecode(buf[i:i+name_len].rstrip(b'\0'))
+            i += name_len
+            p = os.path.join(self.dirs.get(wd, ''), name)
+            if p in self.paths:
+                changed.add(p)
+        return changed
+
+    def Close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def MakeWatcher(paths, poll=False):
+    # inotify where we can, polling otherwise.
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as e:
+            print(f'inotify unavailable ({e}); falling back to polling')
+    return PollingWatcher(paths)
+
+
+class SimfileWatch:
+    """
+    Keeps a set of simfile -> FNF song injections up to date. Each time a
+    simfile settles after being saved, only the difficulty JSONs whose
+    opponent or player chart actually changed are rewritten.
+    """
+
+    def __init__(self, path, entries, slots=None, debounce=0.3, engine=fnf_util.DEFAULT_ENGINE):
+        self.path = path
+        self.engine = engine
+        self.itch = fnf_util.CheckFunkinEXE(path)
+        self.slots = slots or dict(fnf_util.SLOTS)
+        self.debounce = debounce
+        self.entries = {}
+        for e in entries:
+            fn = os.path.abspath(fnf_util.CheckSimfile(e['simfile']))
+            self.entries.setdefault(fn, []).append(e)
+        self.hashes = {}        # (simfile, song) -> chart slot -> hash, as of the last successful injection
+
+    def Reinject(self, fn, t_event=None):
+        t_start = time.perf_counter()
+        if t_event is None:
+            t_event = t_start
+
+        charts = fnf_util.LoadCharts(fn)
+        hashes = {c: ChartHash(charts[c]) for c in charts}
+
+        compiled = {}
+        with output_util.OutputStage() as output:
+            for e in self.entries[fn]:
+                song = e['song']
+                # Compared per song, and only remembered once its files are
+                # committed, so a failed write is retried on the next save.
+                injected = self.hashes.get((fn, song), {})
+                changed = set(c for c in hashes if injected.get(c) != hashes[c])
+                written = []
+                for s, (chart_opp_slot, chart_plr_slot) in e['mapping'].items():
+                    if chart_opp_slot not in changed and chart_plr_slot not in changed:
+                        continue
+                    key = (chart_opp_slot, chart_plr_slot)
+                    if key not in compiled:
+                        compiled[key] = fnf_util.CompileFNF(charts[chart_opp_slot], charts[chart_plr_slot])
+                    song_dict = fnf_util.EmitFNF(compiled[key], e.get('offset', 0.0), e.get('speed', 2.0), song.title(), e.get('engine', self.engine))
+                    output.WriteJSON(os.path.join(self.path, 'assets/data', song, song + self.slots[s] + '.json'), song_dict)
+                    written.append(s)
+                if len(written) > 0:
+                    output.Copy(fn, os.path.join(self.path, 'assets/data', song, song + '-source' + os.path.splitext(fn)[1].lower()))
+                    output.Commit()
+                self.hashes[(fn, song)] = hashes
+
+                t_done = time.perf_counter()
+                if len(written) > 0:
+                    print(f"{song}: re-injected {', '.join(written)} from {os.path.basename(fn)} in {(t_done - t_start)*1000:.0f} ms ({(t_done - t_event)*1000:.0f} ms after the save was noticed)")
+                else:
+                    print(f"{song}: {os.path.basename(fn)} saved, but no mapped charts changed")
+
+    def Run(self, poll=False):
+        for fn in self.entries:
+            self.Reinject(fn)
+
+        watcher = MakeWatcher(list(self.entries), poll=poll)
+        print(f'Watching {len(self.entries)} simfile(s) with {type(watcher).__name__}; Ctrl+C to stop')
+        pending = {}            # simfile -> time the first write of this burst was noticed
+        t_last = 0
+        try:
+            while True:
+                changed = watcher.Wait(self.debounce if len(pending) > 0 else 1.0)
+                now = time.perf_counter()
+                for fn in changed:
+                    pending.setdefault(fn, now)
+                    t_last = now
+                if len(pending) > 0 and now - t_last >= self.debounce:
+                    for fn, t_event in pending.items():
+                        try:
+                            self.Reinject(fn, t_event)
+                        except Exception as e:
+                            print(f'!!! Could not re-inject {fn}: {e}')
+                    pending = {}
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.Close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-inject simfiles into Friday Night Funkin' as they're saved.")
+    parser.add_argument('--defaults', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'SaturdayMorning_defaults.json'),
+                        help='defaults JSON with the FNF "path" and a "watch" list')
+    parser.add_argument('--poll', action='store_true', help="poll for changes even if inotify is available")
+    parser.add_argument('--debounce', type=float, default=0.3, help='seconds of quiet to wait for after a save')
+    args = parser.parse_args()
+
+    with open(args.defaults, 'r') as fp:
+        data = json.load(fp)
+    if 'path' not in data or len(data.get('watch', [])) == 0:
+        raise ValueError(f'"{args.defaults}" needs a "path" to Funkin.exe and a non-empty "watch" list')
+    chart_util.SetChartLimits(data.get('limits'))
+
+    SimfileWatch(data['path'], data['watch'], debounce=args.debounce, engine=data.get('engine', fnf_util.DEFAULT_ENGINE)).Run(poll=args.poll)